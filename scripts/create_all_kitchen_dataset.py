@@ -1,31 +1,32 @@
-import os
-import subprocess
-import time
 import numpy as np
+from omegaconf import DictConfig
+import hydra
+from xskill.dataset.kitchen_mjl_lowdim_dataset import KitchenMjlLowdimDataset
+from xskill.env.kitchen.dataset_renderer import (open_render_store,
+                                                 render_episodes)
 
 
-def main():
-    num_process = 10
-    interval = int(610 / num_process)
-    index = np.arange(0, 610, interval)
-    for embodiment in ['robot', 'human']:
-        # Execute each process in parallel.
-        procs = []
-        for start_eps in index:
-            end_eps = start_eps + interval
-            end_eps = np.clip(end_eps, a_min=0, a_max=603)
-            procs.append(
-                subprocess.Popen([  # pylint: disable=consider-using-with
-                    "python3",
-                    "create_kitchen_dataset.py",
-                    f"start_eps={start_eps}",
-                    f"end_eps={end_eps}",
-                    f"embodiment={embodiment}",
-                ]))
-
-        # Wait for each process to terminate.
-        for p in procs:
-            p.wait()
+@hydra.main(version_base=None,
+            config_path="../config/simulation",
+            config_name="create_kitchen_dataset")
+def main(cfg: DictConfig):
+    # parse the mjl logs once for both embodiments
+    kitchen_dataset = KitchenMjlLowdimDataset(dataset_dir=cfg.dataset_dir)
+    replay_buffer = kitchen_dataset.replay_buffer
+    for embodiment in cfg.embodiments:
+        # save_dir and zarr_path interpolate the embodiment
+        cfg.embodiment = embodiment
+        store = open_render_store(cfg)
+        render_episodes(replay_buffer,
+                        np.arange(replay_buffer.n_episodes),
+                        embodiment=embodiment,
+                        save_dir=cfg.save_dir,
+                        res=cfg.res,
+                        num_workers=cfg.num_workers,
+                        overwrite=cfg.overwrite,
+                        store=store)
+        if store is not None:
+            store.close()
 
 
 if __name__ == "__main__":
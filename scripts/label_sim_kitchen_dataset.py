@@ -1,21 +1,21 @@
+import concurrent.futures
 import numpy as np
 from PIL import Image
 import os
-from skimage.transform import resize
 from tqdm import tqdm
 from omegaconf import DictConfig
 import hydra
 import json
 import torch
 import torchvision.transforms as Tr
-from torchvision import transforms, datasets
-import torch.nn.functional as F
-from torch import nn, einsum
+from torchvision import transforms
+from torch import nn
 import omegaconf
-from tqdm import tqdm
 import pandas as pd
 import seaborn as sns
 import cv2
+from xskill.dataset.prototype_store import PrototypeStore, PrototypeStoreWriter
+from xskill.model.label_engine import EmbeddingEngine
 
 OBS_ELEMENT_INDICES = {
     "bottom burner": np.array([11, 12]),
@@ -60,11 +60,6 @@ def detect_moving_objects_array(arr, obs_indices, threshold=0.005):
     return moving_objects_array
 
 
-def repeat_last_proto(encode_protos, eps_len):
-    rep_proto = encode_protos[-1].unsqueeze(0).repeat(eps_len - len(encode_protos), 1)
-    return torch.cat([encode_protos, rep_proto])
-
-
 def load_state_and_to_tensor(vid):
     state_path = os.path.join(vid, "states.json")
     with open(state_path, "r") as f:
@@ -120,14 +115,6 @@ def load_model(cfg):
     return model
 
 
-def convert_images_to_tensors(images_arr, pipeline):
-    images_tensor = np.transpose(images_arr, (0, 3, 1, 2))  # (T,dim,h,w)
-    images_tensor = torch.tensor(images_tensor, dtype=torch.float32) / 255
-    images_tensor = pipeline(images_tensor)
-
-    return images_tensor
-
-
 @hydra.main(
     version_base=None,
     config_path="../config/simulation",
@@ -141,94 +128,71 @@ def label_dataset(cfg: DictConfig):
     )
     pipeline = nn.Sequential(Tr.CenterCrop((112, 112)), normalize)
 
-    for demo_type in ["human", "robot"]:
-        data_path = os.path.join(cfg.data_path, demo_type)
-        all_folders = os.listdir(data_path)
-        all_folders = sorted(all_folders, key=lambda x: int(x))
-        if cfg.plot_top_k is not None:
-            all_folders = all_folders[: cfg.plot_top_k]
-        for folder_path in tqdm(all_folders, disable=not cfg.verbose):
+    engine = EmbeddingEngine(model,
+                             pipeline,
+                             frame_batch_size=cfg.frame_batch_size,
+                             window_batch_size=cfg.window_batch_size)
+
+    def load_episode(data_folder):
+        images_arr = load_images(data_folder, resize_shape=cfg.resize_shape)
+        # bbox_arr = load_bbox(data_folder)
+        state_arr = load_state_and_to_tensor(data_folder)
+        moved_obj = detect_moving_objects_array(state_arr, OBS_ELEMENT_INDICES)
+        moved_obj = np.array(moved_obj, dtype=np.int32)
+        return images_arr, moved_obj
+
+    with concurrent.futures.ThreadPoolExecutor(
+            cfg.num_load_threads) as load_pool:
+        for demo_type in ["human", "robot"]:
+            data_path = os.path.join(cfg.data_path, demo_type)
+            all_folders = os.listdir(data_path)
+            all_folders = sorted(all_folders, key=lambda x: int(x))
+            if cfg.plot_top_k is not None:
+                all_folders = all_folders[: cfg.plot_top_k]
+            batches = [
+                all_folders[i : i + cfg.episode_batch_size]
+                for i in range(0, len(all_folders), cfg.episode_batch_size)
+            ]
+
+            def submit(batch):
+                return [
+                    load_pool.submit(load_episode, os.path.join(data_path, f))
+                    for f in batch
+                ]
+
             # store the proto in proto pretrain folder
             if demo_type == "human":
-                save_folder = os.path.join(
-                    cfg.exp_path, "human_encode_protos", f"ckpt_{cfg.ckpt}", folder_path
+                proto_dir = os.path.join(
+                    cfg.exp_path, "human_encode_protos", f"ckpt_{cfg.ckpt}"
                 )
             else:
-                save_folder = os.path.join(
-                    cfg.exp_path, "encode_protos", f"ckpt_{cfg.ckpt}", folder_path
+                proto_dir = os.path.join(cfg.exp_path, "encode_protos", f"ckpt_{cfg.ckpt}")
+            writer = PrototypeStoreWriter(proto_dir)
+
+            # load the next batch from disk while the current one is encoded
+            next_futures = submit(batches[0]) if len(batches) > 0 else []
+            for batch_idx, batch in enumerate(tqdm(batches, disable=not cfg.verbose)):
+                loaded = [f.result() for f in next_futures]
+                if batch_idx + 1 < len(batches):
+                    next_futures = submit(batches[batch_idx + 1])
+
+                labels = engine.label_episodes([images for images, _ in loaded])
+                writer.add_episodes(
+                    batch,
+                    [
+                        {
+                            "prototypes": label["encode_protos"],
+                            "softmax_prototypes": label["softmax_encode_protos"],
+                            "raw_rep": label["traj_representation"],
+                            "affordance_state_embs": label["affordance_state_embs"],
+                            "moved_obj": moved_obj,
+                        }
+                        for (_, moved_obj), label in zip(loaded, labels)
+                    ],
                 )
-            os.makedirs(save_folder, exist_ok=True)
-
-            data_folder = os.path.join(data_path, folder_path)
-
-            images_arr = load_images(data_folder, resize_shape=cfg.resize_shape)
-            # bbox_arr = load_bbox(data_folder)
-            state_arr = load_state_and_to_tensor(data_folder)
-            moved_obj = detect_moving_objects_array(state_arr, OBS_ELEMENT_INDICES)
-            moved_obj = np.array(moved_obj, dtype=np.int32)
-            moved_obj = moved_obj.tolist()
-
-            images_tensor = convert_images_to_tensors(images_arr, pipeline).cuda()
-            # images_tensor = images_tensor.unsqueeze(0).cuda()
-
-            # bbox_tensor = torch.tensor(bbox_arr, dtype=torch.float32).cuda()
-            # bbox_tensor = bbox_tensor.unsqueeze(0).cuda()
-
-            eps_len = images_tensor.shape[0]
-            im_q = torch.stack(
-                [
-                    images_tensor[j : j + model.slide + 1]
-                    for j in range(eps_len - model.slide)
-                ]
-            )  # (b,slide+1,c,h,w)
-            # bbox_q = torch.stack([
-            #     bbox_tensor[j:j + model.slide + 1]
-            #     for j in range(eps_len - model.slide)
-            # ])  #(b,slide,n,4)
-
-            z = model.encoder_q(im_q, None)
-            softmax_z = torch.softmax(z / model.T, dim=1)
-            affordance_emb = model.skill_prior(im_q[:, : model.stack_frames], None)
-
-            state_representation = model.encoder_q.get_state_representation(im_q, None)
-            traj_representation = model.encoder_q.get_traj_representation(
-                state_representation
-            )
-            traj_representation = repeat_last_proto(traj_representation, eps_len)
-            traj_representation = traj_representation.detach().cpu().numpy()
-            traj_representation = np.array(traj_representation).tolist()
-
-            encode_protos = repeat_last_proto(z, eps_len)
-            encode_protos = encode_protos.detach().cpu().numpy()
-            encode_protos = np.array(encode_protos).tolist()
-
-            softmax_encode_protos = repeat_last_proto(softmax_z, eps_len)
-            softmax_encode_protos = softmax_encode_protos.detach().cpu().numpy()
-            softmax_encode_protos = np.array(softmax_encode_protos).tolist()
-
-            affordance_state_embs = affordance_emb.detach().cpu().numpy()
-            affordance_state_embs = np.array(affordance_state_embs).tolist()
-
-            with open(os.path.join(save_folder, "encode_protos.json"), "w") as f:
-                json.dump(encode_protos, f)
-
-            with open(
-                os.path.join(save_folder, "softmax_encode_protos.json"), "w"
-            ) as f:
-                json.dump(softmax_encode_protos, f)
-
-            with open(
-                os.path.join(save_folder, "affordance_state_embs.json"), "w"
-            ) as f:
-                json.dump(affordance_state_embs, f)
-
-            with open(os.path.join(save_folder, "traj_representation.json"), "w") as f:
-                json.dump(traj_representation, f)
-
-            with open(os.path.join(save_folder, "moved_obj.json"), "w") as f:
-                json.dump(moved_obj, f)
+            writer.close()
 
-        # plot_proto_task_relation(demo_type=demo_type, cfg=cfg)
+            # plot_proto_task_relation(demo_type=demo_type, cfg=cfg)
 
 
 def plot_proto_task_relation(demo_type="human", cfg=None):
@@ -239,19 +203,15 @@ def plot_proto_task_relation(demo_type="human", cfg=None):
     else:
         encode_path = os.path.join(cfg.exp_path, "encode_protos", f"ckpt_{cfg.ckpt}")
 
-    all_folders = os.listdir(encode_path)
-    all_folders = sorted(all_folders, key=lambda x: int(x))
+    store = PrototypeStore(encode_path)
+    all_folders = sorted(store.root["episode_ids"][:])
     if cfg.plot_top_k is not None:
         all_folders = all_folders[: cfg.plot_top_k]
     softmax_protos = []
     labels = []
     for f in all_folders:
-        with open(
-            os.path.join(encode_path, f, "softmax_encode_protos.json"), "r"
-        ) as file:
-            softmax_protos.append(np.array(json.load(file)))
-        with open(os.path.join(encode_path, f, "moved_obj.json"), "r") as file:
-            labels.append(np.array(json.load(file)))
+        softmax_protos.append(store.get(f, "softmax_prototypes"))
+        labels.append(store.get(f, "moved_obj"))
 
         # with open(os.path.join(encode_path, f, 'traj_representation.json'), 'r') as file:
         #     raw_skill_representations.append(np.array(json.load(file)))
@@ -0,0 +1,37 @@
+import concurrent.futures
+import os
+from functools import partial
+
+import hydra
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from xskill.dataset.frame_store import pack_video_frames
+from xskill.utility.file_utils import get_subdirs
+
+
+@hydra.main(version_base=None,
+            config_path="../config/simulation",
+            config_name="pack_kitchen_dataset")
+def pack_dataset(cfg: DictConfig):
+    """
+    Convert every kitchen_dataset/{robot,human}/<eps> PNG folder into a
+    single pre-resized uint8 array read by EpisodeTrajDataset(use_packed_frames=True).
+    """
+    resize_shape = None if cfg.resize_shape is None else list(cfg.resize_shape)
+    pack_fn = partial(pack_video_frames,
+                      resize_shape=resize_shape,
+                      overwrite=cfg.overwrite)
+    for embodiment in cfg.embodiments:
+        vids = get_subdirs(os.path.join(cfg.data_path, embodiment),
+                           sort_numerical=True)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=cfg.num_workers) as executor:
+            for _ in tqdm(executor.map(pack_fn, vids),
+                          total=len(vids),
+                          desc=f"Packing {embodiment}"):
+                pass
+
+
+if __name__ == "__main__":
+    pack_dataset()
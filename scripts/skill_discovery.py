@@ -6,7 +6,8 @@ from omegaconf import DictConfig, OmegaConf
 from pytorch_lightning.callbacks import ModelCheckpoint
 import wandb
 from xskill.dataset.dataset import ConcatDataset
-from xskill.utility.transform import get_transform_pipeline
+from xskill.utility.transform import (get_batch_transform_pipeline,
+                                      get_transform_pipeline)
 from lightning.pytorch import seed_everything
 
 
@@ -17,6 +18,10 @@ def pretrain(cfg: DictConfig):
     output_dir = HydraConfig.get().runtime.output_dir
     print(f"output_dir: {output_dir}")
     pretrain_pipeline = get_transform_pipeline(cfg.augmentations)
+    batch_pretrain_pipeline = None
+    if cfg.get('batch_augmentation', False):
+        batch_pretrain_pipeline = get_batch_transform_pipeline(
+            cfg.augmentations)
 
     seed_everything(cfg.seed, workers=True)
     robot_dataset = hydra.utils.instantiate(cfg.robot_dataset)
@@ -38,6 +43,7 @@ def pretrain(cfg: DictConfig):
         cfg.Model,
         steps_per_epoch=steps_per_epoch,
         pretrain_pipeline=pretrain_pipeline,
+        batch_pretrain_pipeline=batch_pretrain_pipeline,
     )
 
     print("dataset len: ", len(combine_dataset))
@@ -50,10 +56,6 @@ def pretrain(cfg: DictConfig):
         filename="{epoch:02d}",
     )
 
-    # Set up logger
-    wandb.init(project="kitchen_prototype_learning")
-    # wandb_logger = WandbLogger(project="visual_skill_prior")
-    wandb.config.update(OmegaConf.to_container(cfg))
     trainer = pl.Trainer(
         # logger=wandb_logger,
         callbacks=[checkpoint_callback],
@@ -63,6 +65,14 @@ def pretrain(cfg: DictConfig):
         **cfg.Trainer,
     )
 
+    # Set up logger
+    # the ranks are known once the trainer is built, only the global zero
+    # rank logs, wandb.log is a no-op on the other ranks
+    wandb.init(project="kitchen_prototype_learning",
+               mode=None if trainer.global_rank == 0 else "disabled")
+    # wandb_logger = WandbLogger(project="visual_skill_prior")
+    wandb.config.update(OmegaConf.to_container(cfg))
+
     trainer.fit(model=model, train_dataloaders=dataloader)
 
 
@@ -11,6 +11,7 @@ from diffusers.training_utils import EMAModel
 from omegaconf import DictConfig, OmegaConf
 from xskill.model.diffusion_model import get_resnet, replace_bn_with_gn
 from xskill.model.encoder import ResnetConv
+from xskill.common.pytorch_util import BatchDataset
 import random
 
 
@@ -50,11 +51,16 @@ def train_diffusion_bc(cfg: DictConfig):
         pickle.dump(stats, f)
 
     # create dataloader
-    dataloader = torch.utils.data.DataLoader(
-        dataset,
+    # the dataset gathers whole batches at once in get_batch
+    batch_sampler = torch.utils.data.BatchSampler(
+        torch.utils.data.RandomSampler(dataset),
         batch_size=cfg.batch_size,
+        drop_last=False)
+    dataloader = torch.utils.data.DataLoader(
+        BatchDataset(dataset),
+        sampler=batch_sampler,
+        batch_size=None,
         num_workers=cfg.num_workers,
-        shuffle=True,
         # accelerate cpu-gpu transfer
         pin_memory=cfg.pin_memory,
         # don't kill worker process afte each epoch
@@ -117,6 +123,16 @@ def train_diffusion_bc(cfg: DictConfig):
     # device transfer
     device = torch.device("cuda")
     _ = nets.to(device)
+    if cfg.channels_last:
+        _ = nets.to(memory_format=torch.channels_last)
+
+    # mixed precision, the loss is scaled only for fp16
+    amp_dtype = {
+        "fp32": torch.float32,
+        "bf16": torch.bfloat16,
+        "fp16": torch.float16,
+    }[cfg.precision]
+    scaler = torch.cuda.amp.GradScaler(enabled=cfg.precision == "fp16")
 
     # Exponential Moving Average
     # accelerates training and improves stability
@@ -161,71 +177,79 @@ def train_diffusion_bc(cfg: DictConfig):
             proto_snap = proto_snap.reshape(B, dataset.snap_frames, -1)
             naction = nbatch["actions"].to(device)
 
-            # encoder vision features
-            image_features = nets["vision_encoder"](nimage.flatten(end_dim=1))
-            image_features = image_features.reshape(
-                *nimage.shape[:2], -1)  # (B,obs_horizon,visual_feature)
-
-            obs_feature = torch.cat(
-                [image_features, nobs],
-                dim=-1)  # (B,obs_horizon,low_dim_feature+visual_feature)
-            # predict the proto: (B,obs_horizon*(low_dim_feature+visual_feature))),(B,snap_frames,D)
-            predict_proto = proto_pred_net(obs_feature.flatten(start_dim=1),
-                                           proto_snap)
-
-            # (B, proto_horizon, obs_dim)
-            nobs = nobs[:, :obs_horizon, :]
-
-            if cfg.upsample_proto:
-                upsample_proto = upsample_proto_net(
-                    nproto.flatten(start_dim=1))
-                upsample_proto = upsample_proto.reshape(
-                    B, cfg.proto_horizon, -1)  # (B,proto_horizon,upsample_dim)
-                obs_cond = torch.cat(
-                    [
-                        obs_feature.flatten(start_dim=1),
-                        upsample_proto.flatten(start_dim=1),
-                    ],
-                    dim=1,
-                )
-            else:
-                # feed in: (B,obs_feature*obs_horizon),(B,snap_frame,D)
-                obs_cond = torch.cat(
-                    [
-                        obs_feature.flatten(start_dim=1),
-                        nproto.flatten(start_dim=1)
-                    ],
-                    dim=1,
-                )
-
-            # sample noise to add to actions
-            noise = torch.randn(naction.shape, device=device)
-
-            # sample a diffusion iteration for each data point
-            timesteps = torch.randint(
-                0,
-                noise_scheduler.config.num_train_timesteps, (B, ),
-                device=device).long()
-
-            # add noise to the clean images according to the noise magnitude at each diffusion iteration
-            # (this is the forward diffusion process)
-            noisy_actions = noise_scheduler.add_noise(naction, noise,
-                                                      timesteps)
-
-            # predict the noise residual
-            noise_pred = noise_pred_net(noisy_actions,
-                                        timesteps,
-                                        global_cond=obs_cond)
-
-            # L2 loss
-            action_loss = nn.functional.mse_loss(noise_pred, noise)
-            proto_prediction_loss = nn.functional.mse_loss(
-                predict_proto, nproto.squeeze(1))
-            loss = action_loss + proto_prediction_loss
+            with torch.autocast(device_type=device.type,
+                                dtype=amp_dtype,
+                                enabled=amp_dtype != torch.float32):
+                # encoder vision features
+                flat_image = nimage.flatten(end_dim=1)
+                if cfg.channels_last:
+                    flat_image = flat_image.contiguous(
+                        memory_format=torch.channels_last)
+                image_features = nets["vision_encoder"](flat_image)
+                image_features = image_features.reshape(
+                    *nimage.shape[:2], -1)  # (B,obs_horizon,visual_feature)
+
+                obs_feature = torch.cat(
+                    [image_features, nobs],
+                    dim=-1)  # (B,obs_horizon,low_dim_feature+visual_feature)
+                # predict the proto: (B,obs_horizon*(low_dim_feature+visual_feature))),(B,snap_frames,D)
+                predict_proto = proto_pred_net(obs_feature.flatten(start_dim=1),
+                                               proto_snap)
+
+                # (B, proto_horizon, obs_dim)
+                nobs = nobs[:, :obs_horizon, :]
+
+                if cfg.upsample_proto:
+                    upsample_proto = upsample_proto_net(
+                        nproto.flatten(start_dim=1))
+                    upsample_proto = upsample_proto.reshape(
+                        B, cfg.proto_horizon, -1)  # (B,proto_horizon,upsample_dim)
+                    obs_cond = torch.cat(
+                        [
+                            obs_feature.flatten(start_dim=1),
+                            upsample_proto.flatten(start_dim=1),
+                        ],
+                        dim=1,
+                    )
+                else:
+                    # feed in: (B,obs_feature*obs_horizon),(B,snap_frame,D)
+                    obs_cond = torch.cat(
+                        [
+                            obs_feature.flatten(start_dim=1),
+                            nproto.flatten(start_dim=1)
+                        ],
+                        dim=1,
+                    )
+
+                # sample noise to add to actions
+                noise = torch.randn(naction.shape, device=device)
+
+                # sample a diffusion iteration for each data point
+                timesteps = torch.randint(
+                    0,
+                    noise_scheduler.config.num_train_timesteps, (B, ),
+                    device=device).long()
+
+                # add noise to the clean images according to the noise magnitude at each diffusion iteration
+                # (this is the forward diffusion process)
+                noisy_actions = noise_scheduler.add_noise(naction, noise,
+                                                          timesteps)
+
+                # predict the noise residual
+                noise_pred = noise_pred_net(noisy_actions,
+                                            timesteps,
+                                            global_cond=obs_cond)
+
+                # L2 loss
+                action_loss = nn.functional.mse_loss(noise_pred, noise)
+                proto_prediction_loss = nn.functional.mse_loss(
+                    predict_proto, nproto.squeeze(1))
+                loss = action_loss + proto_prediction_loss
 
             # optimize
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             optimizer.zero_grad()
             # step lr scheduler every batch
             # this is different from standard pytorch behavior
@@ -264,23 +288,18 @@ def train_diffusion_bc(cfg: DictConfig):
                     print(f"evaluating {demo_type} ratio:{task_progess_ratio}")
                     # set task progress ratio
                     eval_callback.task_progess_ratio = task_progess_ratio
-                    total_rewards = []
-                    order_rewards = []
                     if epoch_idx == 0:
                         n_evaluations = 1
                     else:
                         n_evaluations = cfg.eval_cfg.n_evaluations
-                    for seed in range(n_evaluations):
-                        total_r, order_r = eval_callback.eval(
-                            ema.averaged_model,
-                            noise_scheduler,
-                            stats,
-                            cfg.eval_cfg,
-                            save_dir,
-                            seed,
-                        )
-                        total_rewards.append(total_r)
-                        order_rewards.append(order_r)
+                    total_rewards, order_rewards = eval_callback.eval_seeds(
+                        ema.averaged_model,
+                        noise_scheduler,
+                        stats,
+                        cfg.eval_cfg,
+                        save_dir,
+                        range(n_evaluations),
+                    )
                     wandb.log({
                         f"eval_score/{demo_type}_{task_progess_ratio}_total reward":
                         np.mean(total_rewards),
@@ -290,6 +309,8 @@ def train_diffusion_bc(cfg: DictConfig):
                     if demo_type == "robot":
                         break
 
+    eval_callback.close()
+
 
 if __name__ == "__main__":
     train_diffusion_bc()
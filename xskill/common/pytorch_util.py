@@ -15,6 +15,23 @@ def dict_apply(
             result[key] = func(value)
     return result
 
+class BatchDataset(torch.utils.data.Dataset):
+    """
+    Indexed with a list of sample indices, returns dataset.get_batch of them
+    as one dict of (B,...) arrays. Load it with
+    sampler=BatchSampler(...) and batch_size=None, the default collate then
+    only converts the arrays to tensors.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idxs):
+        return self.dataset.get_batch(idxs)
+
 def pad_remaining_dims(x, target):
     assert x.shape == target.shape[:len(x.shape)]
     return x.reshape(x.shape + (1,)*(len(target.shape) - len(x.shape)))
@@ -1,54 +1,114 @@
 from typing import Optional
+import hashlib
+import os
 import numpy as np
-import numba
 from xskill.common.replay_buffer import ReplayBuffer
 
 
-@numba.jit(nopython=True)
+def compute_sample_indices(episode_ends: np.ndarray,
+                           sequence_length: int,
+                           pad_before: int = 0,
+                           pad_after: int = 0,
+                           episode_mask: Optional[np.ndarray] = None
+                           ) -> np.ndarray:
+    """
+    Vectorized sample index table of all sequences of the selected episodes.
+    Returns (N,4) int64 rows of
+    (buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx),
+    sequences start from -pad_before to episode_length - sequence_length
+    + pad_after relative to the episode start.
+    """
+    episode_ends = np.asarray(episode_ends, dtype=np.int64)
+    episode_starts = np.concatenate([[0], episode_ends[:-1]])
+    if episode_mask is not None:
+        assert episode_mask.shape == episode_ends.shape
+        episode_starts = episode_starts[episode_mask]
+        episode_ends = episode_ends[episode_mask]
+    episode_lengths = episode_ends - episode_starts
+
+    n_samples = np.maximum(
+        episode_lengths - sequence_length + pad_after + pad_before + 1, 0)
+    first_sample = np.cumsum(n_samples) - n_samples
+    start_idx = np.repeat(episode_starts, n_samples)
+    episode_length = np.repeat(episode_lengths, n_samples)
+    # sequence start relative to its episode start
+    idx = np.arange(n_samples.sum()) - np.repeat(first_sample,
+                                                 n_samples) - pad_before
+
+    buffer_start_idx = np.maximum(idx, 0) + start_idx
+    buffer_end_idx = np.minimum(idx + sequence_length,
+                                episode_length) + start_idx
+    sample_start_idx = buffer_start_idx - (idx + start_idx)
+    sample_end_idx = sequence_length - (
+        (idx + sequence_length + start_idx) - buffer_end_idx)
+    return np.stack(
+        [buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx],
+        axis=-1).astype(np.int64)
+
+
 def create_indices(episode_ends: np.ndarray,
                    sequence_length: int,
                    episode_mask: np.ndarray,
                    pad_before: int = 0,
                    pad_after: int = 0,
                    debug: bool = True) -> np.ndarray:
-    episode_mask.shape == episode_ends.shape
     pad_before = min(max(pad_before, 0), sequence_length - 1)
     pad_after = min(max(pad_after, 0), sequence_length - 1)
+    indices = compute_sample_indices(episode_ends,
+                                     sequence_length=sequence_length,
+                                     pad_before=pad_before,
+                                     pad_after=pad_after,
+                                     episode_mask=episode_mask)
+    if debug:
+        buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx = \
+            indices.T
+        assert np.all(sample_start_idx >= 0)
+        assert np.all(sample_end_idx <= sequence_length)
+        assert np.all((sample_end_idx - sample_start_idx) == (
+            buffer_end_idx - buffer_start_idx))
+    return indices
+
+
+def create_indices_cached(cache_dir: Optional[str],
+                          episode_ends: np.ndarray,
+                          sequence_length: int,
+                          episode_mask: Optional[np.ndarray] = None,
+                          pad_before: int = 0,
+                          pad_after: int = 0,
+                          create_fn=create_indices) -> np.ndarray:
+    """
+    create_fn(episode_ends, sequence_length=, episode_mask=, pad_before=,
+    pad_after=) with the result cached as .npy in cache_dir, keyed by a hash
+    of the episode ends, the mask and the sequence arguments.
+    No caching if cache_dir is None.
+    """
+    episode_ends = np.asarray(episode_ends, dtype=np.int64)
+    if episode_mask is None:
+        episode_mask = np.ones(episode_ends.shape, dtype=bool)
+    kwargs = dict(sequence_length=sequence_length,
+                  episode_mask=episode_mask,
+                  pad_before=pad_before,
+                  pad_after=pad_after)
+    if cache_dir is None:
+        return create_fn(episode_ends, **kwargs)
+
+    key = hashlib.sha1()
+    key.update(create_fn.__name__.encode())
+    key.update(episode_ends.tobytes())
+    key.update(np.asarray(episode_mask, dtype=bool).tobytes())
+    key.update(
+        np.array([sequence_length, pad_before, pad_after],
+                 dtype=np.int64).tobytes())
+    cache_path = os.path.join(os.path.expanduser(cache_dir),
+                              f"indices_{key.hexdigest()}.npy")
+    if os.path.isfile(cache_path):
+        return np.load(cache_path)
 
-    indices = list()
-    for i in range(len(episode_ends)):
-        if not episode_mask[i]:
-            # skip episode
-            continue
-        start_idx = 0
-        if i > 0:
-            start_idx = episode_ends[i - 1]
-        end_idx = episode_ends[i]
-        episode_length = end_idx - start_idx
-
-        min_start = -pad_before
-        max_start = episode_length - sequence_length + pad_after
-
-        # range stops one idx before end
-        for idx in range(min_start, max_start + 1):
-            buffer_start_idx = max(idx, 0) + start_idx
-            buffer_end_idx = min(idx + sequence_length,
-                                 episode_length) + start_idx
-            start_offset = buffer_start_idx - (idx + start_idx)
-            end_offset = (idx + sequence_length + start_idx) - buffer_end_idx
-            sample_start_idx = 0 + start_offset
-            sample_end_idx = sequence_length - end_offset
-            if debug:
-                assert (start_offset >= 0)
-                assert (end_offset >= 0)
-                assert (sample_end_idx -
-                        sample_start_idx) == (buffer_end_idx -
-                                              buffer_start_idx)
-            indices.append([
-                buffer_start_idx, buffer_end_idx, sample_start_idx,
-                sample_end_idx
-            ])
-    indices = np.array(indices)
+    indices = create_fn(episode_ends, **kwargs)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + f".{os.getpid()}.tmp.npy"
+    np.save(tmp_path, indices)
+    os.replace(tmp_path, cache_path)
     return indices
 
 
@@ -93,10 +153,12 @@ class SequenceSampler:
             keys=None,
             key_first_k=dict(),
             episode_mask: Optional[np.ndarray] = None,
+            index_cache_dir: Optional[str] = None,
     ):
         """
         key_first_k: dict str: int
             Only take first k data from these keys (to improve perf)
+        index_cache_dir: folder to cache the sample index table in
         """
 
         super().__init__()
@@ -109,11 +171,12 @@ class SequenceSampler:
             episode_mask = np.ones(episode_ends.shape, dtype=bool)
 
         if np.any(episode_mask):
-            indices = create_indices(episode_ends,
-                                     sequence_length=sequence_length,
-                                     pad_before=pad_before,
-                                     pad_after=pad_after,
-                                     episode_mask=episode_mask)
+            indices = create_indices_cached(index_cache_dir,
+                                            episode_ends,
+                                            sequence_length=sequence_length,
+                                            pad_before=pad_before,
+                                            pad_after=pad_after,
+                                            episode_mask=episode_mask)
         else:
             indices = np.zeros((0, 4), dtype=np.int64)
 
@@ -164,3 +227,50 @@ class SequenceSampler:
                 data[sample_start_idx:sample_end_idx] = sample
             result[key] = data
         return result
+
+    def get_sample_rows(self, idxs):
+        """
+        (B,sequence_length) buffer rows of the samples idxs, padded steps
+        repeat the first / last step of the episode
+        """
+        buffer_start_idx, buffer_end_idx, sample_start_idx, _ = \
+            self.indices[idxs].T
+        rows = (buffer_start_idx - sample_start_idx)[:, None] + np.arange(
+            self.sequence_length)
+        return np.clip(rows, buffer_start_idx[:, None],
+                       buffer_end_idx[:, None] - 1)
+
+    def sample_sequences(self, idxs):
+        """
+        Batched sample_sequence, every key is gathered for the whole batch
+        with one clipped row index matrix instead of padding each sample.
+        returns dict of (B,sequence_length,...) arrays
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        rows = self.get_sample_rows(idxs)
+        result = dict()
+        for key in self.keys:
+            input_arr = self.replay_buffer[key]
+            if key not in self.key_first_k:
+                result[key] = gather_rows(input_arr, rows)
+            else:
+                # only load the first k steps of each sample, the others are
+                # filled with Nan to catch bugs
+                buffer_start_idx = self.indices[idxs, 0][:, None]
+                loaded = (rows - buffer_start_idx) < self.key_first_k[key]
+                data = gather_rows(input_arr,
+                                   np.where(loaded, rows, buffer_start_idx))
+                data[~loaded] = np.nan
+                result[key] = data
+        return result
+
+
+def gather_rows(arr, rows):
+    """
+    arr[rows] for numpy and zarr arrays, zarr arrays read every needed row
+    once in a single orthogonal selection.
+    """
+    if isinstance(arr, np.ndarray):
+        return arr[rows]
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    return arr.oindex[unique_rows][inverse.reshape(rows.shape)]
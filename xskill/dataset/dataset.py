@@ -3,12 +3,15 @@ import numpy as np
 import torch
 from xskill.utility.file_utils import get_subdirs
 from xskill.utility.file_utils import load_image
+from xskill.dataset.frame_store import load_packed_frames
+from xskill.dataset.frame_samplers import SingleVideoFrameSampler
+from xskill.dataset.decode_pool import map_in_pool, resolve_num_threads
 import random
 import collections
 import torchvision.transforms as T
 import pathlib
 import json
-import concurrent.futures
+import os
 import cv2
 IndexBatch = namedtuple("IndexBatch", "im_q index info")
 
@@ -23,14 +26,35 @@ class EpisodeTrajDataset(torch.utils.data.Dataset):
         vid_mask = None,
         max_get_threads = 4,
         resize_shape=[135, 135],
+        use_packed_frames=False,
+        frame_index_manifest=None,
+        num_workers=0,
+        uint8_output=False,
     ) -> None:
+        """
+        uint8_output: return the raw uint8 (T,h,w,c) frames and leave the
+            permute and scaling to Model.on_after_batch_transfer on device.
+        use_packed_frames: read frames from the per-episode arrays written by
+            scripts/pack_kitchen_dataset.py instead of decoding PNGs.
+        frame_index_manifest: file name of the frame index manifest stored in
+            each allowed dir, e.g. 'frame_index.json'. None keeps the index
+            in memory only.
+        max_get_threads: decode threads per DataLoader worker. None splits the
+            cpu cores evenly between the num_workers DataLoader workers.
+        """
         super().__init__()
         self._frame_sampler = frame_sampler
-        self.max_get_threads=max_get_threads
+        self.use_packed_frames = use_packed_frames
+        # opened lazily so every DataLoader worker maps its own copy
+        self._packed_frames = {}
+        self.max_get_threads = resolve_num_threads(max_get_threads,
+                                                   num_workers)
+        self.uint8_output = uint8_output
         self.resize_shape=resize_shape
         self._seed = seed
         self.slide = slide
         self.sort_numerical = sort_numerical
+        self.frame_index_manifest = frame_index_manifest
         if vid_mask is not None:
             with open(vid_mask, 'r') as f:
                 self.vid_mask = json.load(f)
@@ -64,11 +88,23 @@ class EpisodeTrajDataset(torch.utils.data.Dataset):
                 if self.vid_mask is not None:
                     vids = vids[self.vid_mask]
                 self._dir_tree[path] = vids
+                self._build_frame_index(path, vids)
                 for j, v in enumerate(vids):
                     self._indexfile[num_vids] = (i, j)
                     num_vids += 1
 
 
+    def _build_frame_index(self, path, vids):
+        """List the frames of every video once instead of per sample."""
+        if self.use_packed_frames or not isinstance(
+                self._frame_sampler, SingleVideoFrameSampler):
+            return
+        manifest_path = None
+        if self.frame_index_manifest is not None:
+            manifest_path = os.path.join(path, self.frame_index_manifest)
+        self._frame_sampler.build_frame_index(vids,
+                                              manifest_path=manifest_path)
+
     @property
     def class_names(self):
         """The stems of the allowed video class subdirs."""
@@ -89,41 +125,37 @@ class EpisodeTrajDataset(torch.utils.data.Dataset):
         return self._dir_tree[action_class][vid_idx]
 
     def _get_sequence_data(self, sample,resize_shape=None):
-        frame_paths = np.array([str(f) for f in sample["frames"]])
-        frame_paths = np.take(frame_paths, sample["ctx_idxs"], axis=0)
-        frame_paths = frame_paths.flatten()
-
-        frames = [None for _ in range(len(frame_paths))]
+        frame_paths = np.asarray(sample["frames"], dtype=str)
+        frame_paths = frame_paths[sample["ctx_idxs"].ravel()]
 
-        def get_image(image_index, image_path,frames,resize_shape):
-            try:
-                if resize_shape is not None:
+        def get_images(image_paths):
+            frames = []
+            for image_path in image_paths:
+                try:
                     frame = load_image(image_path)
-                    resized_frames = cv2.resize(frame, resize_shape)
-                    frames[image_index] = resized_frames
-                else:
-                    frames[image_index] = load_image(image_path)
-                return True
-            except Exception as e:
-                print(image_index,image_path)
-                return False
-
-        with concurrent.futures.ThreadPoolExecutor(
-                max_workers=self.max_get_threads) as executor:
-            futures = set()
-            for i, idx in enumerate(frame_paths):
-                futures.add(
-                    executor.submit(get_image, i, idx, frames,resize_shape))
-
-            completed, futures = concurrent.futures.wait(futures)
-            for f in completed:
-                if not f.result():
-                    raise RuntimeError('Failed to get image!')
-                
+                    if resize_shape is not None:
+                        frame = cv2.resize(frame, resize_shape)
+                except Exception as e:
+                    print(image_path)
+                    raise RuntimeError('Failed to get image!') from e
+                frames.append(frame)
+            return frames
+
+        frames = map_in_pool(get_images, frame_paths, self.max_get_threads)
         sequence_data = np.stack(frames)  # Shape: (S * X, H, W, C)
 
         return sequence_data
 
+    def _get_packed_frames(self, vid_path):
+        if vid_path not in self._packed_frames:
+            self._packed_frames[vid_path] = load_packed_frames(
+                vid_path, self.resize_shape)
+        return self._packed_frames[vid_path]
+
+    def _get_packed_sequence_data(self, sample, packed_frames):
+        # fancy indexing copies the rows out of the memory map
+        return packed_frames[sample["ctx_idxs"].ravel()]  # Shape: (S * X, H, W, C)
+
 
     def __len__(self):
         return len(self._indexfile)
@@ -135,14 +167,24 @@ class EpisodeTrajDataset(torch.utils.data.Dataset):
         info['class_idx'] = class_idx
         info['vid_idx'] = vid_idx
         vid_paths = self._get_video_path(class_idx, vid_idx)
-        sample = self._frame_sampler.sample(vid_paths)
-        sequence_data = self._get_sequence_data(sample,self.resize_shape)  # (T,h,w,dim)
+        if self.use_packed_frames:
+            packed_frames = self._get_packed_frames(vid_paths)
+            sample = self._frame_sampler.sample_frames(
+                np.arange(len(packed_frames)))
+            sequence_data = self._get_packed_sequence_data(
+                sample, packed_frames)  # (T,h,w,dim)
+        else:
+            sample = self._frame_sampler.sample(vid_paths)
+            sequence_data = self._get_sequence_data(sample,self.resize_shape)  # (T,h,w,dim)
 
         im_q = self.transform(sequence_data)
         return IndexBatch(im_q, idx, info)
 
 
     def transform(self, sequence_data):
+        if self.uint8_output:
+            # (T,h,w,dim) uint8, a quarter of the bytes of float32
+            return np.ascontiguousarray(sequence_data)
         # Horig, Worig = sequence_data.shape[1:3]
         sequence_data = np.transpose(sequence_data, (0, 3, 1, 2)).astype(
             np.float32)  # (T,dim,h,w)
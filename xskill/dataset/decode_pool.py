@@ -0,0 +1,66 @@
+"""Long lived thread pools for decoding frames inside DataLoader workers."""
+
+import concurrent.futures
+import multiprocessing
+import os
+
+import numpy as np
+
+_pools = {}
+_pools_pid = None
+
+
+def get_decode_pool(max_workers):
+    """Return the thread pool of the current process.
+
+  The pool is created lazily on first use. Threads do not survive a fork, so
+  every DataLoader worker process creates and keeps its own pool.
+  """
+    global _pools, _pools_pid
+    pid = os.getpid()
+    if _pools_pid != pid:
+        # inherited from the parent process, its threads are gone
+        _pools = {}
+        _pools_pid = pid
+    if max_workers not in _pools:
+        _pools[max_workers] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+    return _pools[max_workers]
+
+
+def resolve_num_threads(max_get_threads=None, num_workers=0):
+    """Number of decode threads per DataLoader worker.
+
+  Args:
+    max_get_threads: Explicit number of threads. If None, the cpu cores are
+      split evenly between the DataLoader workers.
+    num_workers: Number of DataLoader worker processes.
+  """
+    if max_get_threads is not None:
+        return int(max_get_threads)
+    return max(1, multiprocessing.cpu_count() // max(1, num_workers))
+
+
+def map_in_pool(fn, items, max_workers):
+    """Apply `fn` to contiguous chunks of `items` in the decode pool.
+
+  All items of a sample are submitted at once as at most `max_workers`
+  chunks instead of one future per item.
+
+  Args:
+    fn: Callable taking a list of items and returning a list of results.
+    items: The items to process.
+    max_workers: Size of the decode pool.
+
+  Returns:
+    The list of results in the order of `items`.
+  """
+    if max_workers <= 1 or len(items) <= 1:
+        return fn(list(items))
+    pool = get_decode_pool(max_workers)
+    chunks = np.array_split(np.arange(len(items)),
+                            min(max_workers, len(items)))
+    results = []
+    for chunk_result in pool.map(fn, [[items[i] for i in c] for c in chunks]):
+        results.extend(chunk_result)
+    return results
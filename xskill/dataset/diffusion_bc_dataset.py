@@ -12,6 +12,18 @@ from tqdm import tqdm
 from pathlib import Path
 from tqdm import tqdm
 import cv2
+import shutil
+import zarr
+from xskill.common.replay_buffer import ReplayBuffer
+from xskill.common.sampler import (
+    compute_sample_indices,
+    create_indices_cached,
+    gather_rows,
+)
+from xskill.model.common.normalizer import SingleFieldLinearNormalizer
+from xskill.dataset.prototype_store import (PrototypeStore,
+                                            has_prototype_store,
+                                            load_prototypes)
 
 normalize_threshold = 5e-2
 
@@ -21,31 +33,15 @@ def create_sample_indices(
     sequence_length: int,
     pad_before: int = 0,
     pad_after: int = 0,
+    episode_mask: np.ndarray = None,
 ):
-    indices = list()
-    for i in range(len(episode_ends)):
-        start_idx = 0
-        if i > 0:
-            start_idx = episode_ends[i - 1]
-        end_idx = episode_ends[i]
-        episode_length = end_idx - start_idx
-
-        min_start = -pad_before
-        max_start = episode_length - sequence_length + pad_after
-
-        # range stops one idx before end
-        for idx in range(min_start, max_start + 1):
-            buffer_start_idx = max(idx, 0) + start_idx
-            buffer_end_idx = min(idx + sequence_length, episode_length) + start_idx
-            start_offset = buffer_start_idx - (idx + start_idx)
-            end_offset = (idx + sequence_length + start_idx) - buffer_end_idx
-            sample_start_idx = 0 + start_offset
-            sample_end_idx = sequence_length - end_offset
-            indices.append(
-                [buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx]
-            )
-    indices = np.array(indices)
-    return indices
+    return compute_sample_indices(
+        episode_ends,
+        sequence_length=sequence_length,
+        pad_before=pad_before,
+        pad_after=pad_after,
+        episode_mask=episode_mask,
+    )
 
 
 def sample_sequence(
@@ -80,28 +76,92 @@ def get_data_stats(data):
     return stats
 
 
+class DataNormalizer:
+    """
+    Min/max normalization with a precomputed per column scale and offset.
+    Columns whose range exceeds normalize_threshold are mapped to [-1, 1],
+    the others are left unchanged. Works on numpy arrays and torch tensors
+    on any device, never modifies its input, and pickles into stats.pickle.
+
+    Inputs may have fewer columns than the stats, the leading columns are
+    used, e.g. the 9 robot dims of the 30 dim observation.
+    """
+
+    def __init__(self, stats):
+        self.min = np.asarray(stats["min"], dtype=np.float32)
+        self.max = np.asarray(stats["max"], dtype=np.float32)
+        input_range = self.max - self.min
+        normalized = input_range > normalize_threshold
+        self.scale = np.where(
+            normalized, 2 / np.where(normalized, input_range, 1), 1
+        ).astype(np.float32)
+        self.offset = np.where(normalized, -1 - self.scale * self.min, 0).astype(
+            np.float32
+        )
+        self._torch_params = dict()
+
+    def __getitem__(self, key):
+        # dict style access to the stats, as before the normalizer
+        return {"min": self.min, "max": self.max}[key]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_torch_params"] = dict()
+        return state
+
+    def _params(self, x):
+        n = x.shape[-1]
+        if isinstance(x, torch.Tensor):
+            key = (x.device, x.dtype)
+            if key not in self._torch_params:
+                self._torch_params[key] = tuple(
+                    torch.from_numpy(p).to(device=x.device, dtype=x.dtype)
+                    for p in (self.scale, self.offset)
+                )
+            scale, offset = self._torch_params[key]
+        else:
+            scale, offset = self.scale, self.offset
+        return scale[:n], offset[:n]
+
+    def normalize(self, x):
+        scale, offset = self._params(x)
+        nx = x * scale + offset
+        if isinstance(x, np.ndarray):
+            nx = nx.astype(x.dtype, copy=False)
+        return nx
+
+    def unnormalize(self, nx):
+        scale, offset = self._params(nx)
+        x = (nx - offset) / scale
+        if isinstance(nx, np.ndarray):
+            x = x.astype(nx.dtype, copy=False)
+        return x
+
+    def to_linear_normalizer(self):
+        """The same transform as a SingleFieldLinearNormalizer module."""
+        normalizer = SingleFieldLinearNormalizer.create_manual(
+            scale=self.scale,
+            offset=self.offset,
+            input_stats_dict={"min": self.min, "max": self.max},
+        )
+        for p in normalizer.parameters():
+            p.requires_grad_(False)
+        return normalizer
+
+
+def get_data_normalizer(stats):
+    if isinstance(stats, DataNormalizer):
+        return stats
+    return DataNormalizer(stats)
+
+
 def normalize_data(data, stats):
-    # nomalize to [0,1]
-    ndata = data.copy()
-    for i in range(ndata.shape[1]):
-        if stats["max"][i] - stats["min"][i] > normalize_threshold:
-            ndata[:, i] = (data[:, i] - stats["min"][i]) / (
-                stats["max"][i] - stats["min"][i]
-            )
-            # normalize to [-1, 1]
-            ndata[:, i] = ndata[:, i] * 2 - 1
-    return ndata
+    # nomalize to [-1,1]
+    return get_data_normalizer(stats).normalize(data)
 
 
 def unnormalize_data(ndata, stats):
-    data = ndata.copy()
-    for i in range(ndata.shape[1]):
-        if stats["max"][i] - stats["min"][i] > normalize_threshold:
-            ndata[:, i] = (ndata[:, i] + 1) / 2
-            data[:, i] = (
-                ndata[:, i] * (stats["max"][i] - stats["min"][i]) + stats["min"][i]
-            )
-    return data
+    return get_data_normalizer(stats).unnormalize(ndata)
 
 
 class KitchenBCDataset(torch.utils.data.Dataset):
@@ -126,9 +186,18 @@ class KitchenBCDataset(torch.utils.data.Dataset):
         pipeline=None,
         verbose=False,
         seed=0,
+        backing_store=None,
+        index_cache_dir=None,
     ):
         """
         Support 1) raw representation 2) softmax prototype 3) prototype 4) one-hot prototype
+
+        backing_store: path of a zarr ReplayBuffer. If set, the episodes are
+            written there once and __getitem__ reads only the rows of a
+            sample instead of holding the whole dataset in memory. The store
+            is rebuilt when the dataset arguments change.
+        index_cache_dir: folder to cache the sample index table in, keyed by
+            the episode ends and the horizons
         """
         self.verbose = verbose
         self.resize_shape = resize_shape
@@ -152,47 +221,70 @@ class KitchenBCDataset(torch.utils.data.Dataset):
 
         self.data_dirs = data_dirs
         self.proto_dirs = proto_dirs
+        self._proto_store = None
+        if has_prototype_store(proto_dirs):
+            self._proto_store = PrototypeStore(proto_dirs)
         self._build_dir_tree()
 
-        train_data = defaultdict(list)
-        self.load_data(train_data)
+        self.replay_buffer = None
+        if backing_store is not None:
+            self.replay_buffer = self.open_backing_store(backing_store)
+            train_data = None
+            episode_ends = self.replay_buffer.episode_ends[:]
+        else:
+            train_data = defaultdict(list)
+            self.load_data(train_data)
 
-        episode_ends = []
-        for eps_action_data in train_data["actions"]:
-            episode_ends.append(len(eps_action_data))
+            episode_ends = []
+            for eps_action_data in train_data["actions"]:
+                episode_ends.append(len(eps_action_data))
 
-        for k, v in train_data.items():
-            train_data[k] = np.concatenate(v)
+            for k, v in train_data.items():
+                train_data[k] = np.concatenate(v)
 
-        print(f"training data len {len(train_data['actions'])}")
+            # Marks one-past the last index for each episode
+            episode_ends = np.cumsum(episode_ends)
 
-        # Marks one-past the last index for each episode
-        episode_ends = np.cumsum(episode_ends)
+        print(f"training data len {episode_ends[-1]}")
         self.episode_ends = episode_ends
 
         # compute start and end of each state-action sequence
         # also handles padding
-        indices = create_sample_indices(
-            episode_ends=episode_ends,
+        indices = create_indices_cached(
+            index_cache_dir,
+            episode_ends,
             sequence_length=pred_horizon,
             # add padding such that each timestep in the dataset are seen
             pad_before=obs_horizon - 1,
             pad_after=action_horizon - 1,
+            create_fn=create_sample_indices,
         )
 
         # compute statistics and normalized data to [-1,1]
         stats = dict()
-        # normalized_train_data = dict()
-        for key, data in train_data.items():
-            if key == "images" or key in self.unnormal_list:
-                pass
-            else:
-                stats[key] = get_data_stats(data)
-
-            if key == "images" or key in self.unnormal_list:
-                pass
-            else:
-                train_data[key] = normalize_data(data, stats[key])
+        if self.replay_buffer is not None:
+            # low dim data is small enough to be read at once, it is
+            # normalized per sample in __getitem__
+            lazy_data = dict(self.replay_buffer.items())
+            if "proto_snap" in self.replay_buffer.meta:
+                lazy_data["proto_snap"] = self.replay_buffer.meta["proto_snap"]
+            for key, data in lazy_data.items():
+                if key == "images" or key in self.unnormal_list:
+                    pass
+                else:
+                    stats[key] = DataNormalizer(get_data_stats(data[:]))
+        else:
+            # normalized_train_data = dict()
+            for key, data in train_data.items():
+                if key == "images" or key in self.unnormal_list:
+                    pass
+                else:
+                    stats[key] = DataNormalizer(get_data_stats(data))
+
+                if key == "images" or key in self.unnormal_list:
+                    pass
+                else:
+                    train_data[key] = normalize_data(data, stats[key])
 
         self.indices = indices
         self.stats = stats
@@ -242,17 +334,21 @@ class KitchenBCDataset(torch.utils.data.Dataset):
         return state_data
 
     def load_proto_and_to_tensor(self, vid):
-        proto_path = osp.join(self.proto_dirs, os.path.basename(os.path.normpath(vid)))
         if self.raw_representation:
-            proto_path = os.path.join(proto_path, "traj_representation.json")
+            proto_key = "raw_rep"
         elif self.softmax_prototype or self.one_hot_prototype:
-            proto_path = os.path.join(proto_path, "softmax_encode_protos.json")
+            proto_key = "softmax_prototypes"
         elif self.prototype:
-            proto_path = os.path.join(proto_path, "encode_protos.json")
+            proto_key = "prototypes"
 
-        with open(proto_path, "r") as f:
-            proto_data = json.load(f)
-        proto_data = np.array(proto_data, dtype=np.float32)  # (T,D)
+        episode_id = os.path.basename(os.path.normpath(vid))
+        if self._proto_store is not None:
+            proto_data = self._proto_store.get(episode_id, proto_key)
+        else:
+            # labeled before the prototype store
+            proto_data = load_prototypes(self.proto_dirs, episode_id,
+                                         proto_key)
+        proto_data = np.asarray(proto_data, dtype=np.float32)  # (T,D)
         if self.one_hot_prototype:
             one_hot_proto = np.zeros_like(proto_data)
             max_proto = np.argmax(proto_data, axis=1)
@@ -295,68 +391,152 @@ class KitchenBCDataset(torch.utils.data.Dataset):
         return images_arr
 
     def transform_images(self, images_arr):
-        images_arr = images_arr.astype(np.float32)
-        images_tensor = np.transpose(images_arr, (0, 3, 1, 2)) / 255.0  # (T,dim,h,w)
+        # (...,h,w,dim) uint8 to (...,dim,h,w) float in [0,1]
+        images_tensor = np.moveaxis(images_arr, -1, -3).astype(np.float32)
+        images_tensor *= 1 / 255.0
         return images_tensor
 
-    def load_data(self, train_data):
+    def iter_episodes(self):
         # HACK. Fix later
         vid = list(self._dir_tree.values())[0]
         print("loading data")
         for j, v in tqdm(enumerate(vid), desc="Loading data", disable=not self.verbose):
+            episode = dict()
             if self.obs_image_based:
-                images = self.load_images(v)
-                train_data["images"].append(images)
+                episode["images"] = self.load_images(v)
 
-            train_data["obs"].append(self.load_state_and_to_tensor(v))
+            episode["obs"] = self.load_state_and_to_tensor(v)
             if self.prototype_snap:
                 proto_data, proto_snap = self.load_proto_and_to_tensor(v)
-                train_data["proto_snap"].append(proto_snap)
+                episode["proto_snap"] = proto_snap
             else:
                 proto_data = self.load_proto_and_to_tensor(v)
 
-            train_data["protos"].append(proto_data)
-            train_data["actions"].append(self.load_action_and_to_tensor(v))
+            episode["protos"] = proto_data
+            episode["actions"] = self.load_action_and_to_tensor(v)
+            yield episode
+
+    def load_data(self, train_data):
+        for episode in self.iter_episodes():
+            for key, value in episode.items():
+                train_data[key].append(value)
+
+    def get_store_config(self):
+        """Arguments the content of the backing store depends on."""
+        return {
+            "data_dirs": [str(d) for d in self.data_dirs],
+            "proto_dirs": str(self.proto_dirs),
+            "mask": None if self.mask is None else list(self.mask),
+            "resize_shape": None
+            if self.resize_shape is None else list(self.resize_shape),
+            "raw_representation": self.raw_representation,
+            "softmax_prototype": self.softmax_prototype,
+            "prototype": self.prototype,
+            "one_hot_prototype": self.one_hot_prototype,
+            "obs_image_based": self.obs_image_based,
+            "prototype_snap": self.prototype_snap,
+            "snap_frames": self.snap_frames,
+            "seed": self.seed,
+        }
+
+    def open_backing_store(self, path):
+        """Open the zarr ReplayBuffer at path, building it first if needed."""
+        config = self.get_store_config()
+        if os.path.isdir(path):
+            root = zarr.open_group(path, mode="r")
+            if root.attrs.get("config", None) == config:
+                return ReplayBuffer.create_from_group(root)
+            print(f"dataset arguments changed, rebuilding {path}")
+
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        replay_buffer = ReplayBuffer.create_from_path(tmp_path, mode="w")
+        proto_snaps = []
+        for episode in self.iter_episodes():
+            if "proto_snap" in episode:
+                # the snap is the same for every step, store it once
+                proto_snaps.append(episode.pop("proto_snap")[0])
+            chunks = dict()
+            if "images" in episode:
+                # samples read a few frames, chunk per frame
+                chunks["images"] = (1, ) + episode["images"].shape[1:]
+            replay_buffer.add_episode(episode, chunks=chunks)
+        if len(proto_snaps) > 0:
+            replay_buffer.meta.array("proto_snap", np.stack(proto_snaps))
+        replay_buffer.root.attrs["config"] = config
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        return ReplayBuffer.create_from_path(path, mode="r")
 
     def __len__(self):
         # all possible segments of the dataset
         return len(self.indices)
 
-    def __getitem__(self, idx):
-        # get the start/end indices for this datapoint
-        (
-            buffer_start_idx,
-            buffer_end_idx,
-            sample_start_idx,
-            sample_end_idx,
-        ) = self.indices[idx]
-
-        # get nomralized data using these indices
-        nsample = sample_sequence(
-            train_data=self.normalized_train_data,
-            sequence_length=self.pred_horizon,
-            buffer_start_idx=buffer_start_idx,
-            buffer_end_idx=buffer_end_idx,
-            sample_start_idx=sample_start_idx,
-            sample_end_idx=sample_end_idx,
+    def get_sample_rows(self, idxs):
+        """
+        (B,pred_horizon) buffer rows of the samples idxs, padded steps
+        repeat the first / last step of the episode
+        """
+        buffer_start_idx, buffer_end_idx, sample_start_idx, _ = self.indices[idxs].T
+        rows = (buffer_start_idx - sample_start_idx)[:, None] + np.arange(
+            self.pred_horizon
         )
+        return np.clip(rows, buffer_start_idx[:, None], buffer_end_idx[:, None] - 1)
 
-        # discard unused observations
-        nsample["obs"] = nsample["obs"][: self.obs_horizon, :]
+    def get_batch(self, idxs):
+        """
+        Gather the samples idxs at once. Every key is indexed with one clipped
+        row matrix for the whole batch, only the rows that are used are read.
+        returns dict of (B,T,...) arrays
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        rows = self.get_sample_rows(idxs)
+        obs_rows = rows[:, : self.obs_horizon]
         if self.prototype_snap:
-            # set as prediction target
-            nsample["protos"] = nsample["protos"][: self.obs_horizon, :]
             # most recent prototype
-            nsample["protos"] = nsample["protos"][-1:, :]
-            # duplicate. only take one
-            nsample["proto_snap"] = nsample["proto_snap"][-1:, :]
+            proto_rows = obs_rows[:, -1:]
         else:
-            nsample["protos"] = nsample["protos"][: self.obs_horizon, :]
-            nsample["protos"] = nsample["protos"][-self.proto_horizon :, :]
+            proto_rows = obs_rows[:, -self.proto_horizon :]
+
+        if self.replay_buffer is not None:
+            data = self.replay_buffer
+        else:
+            data = self.normalized_train_data
+
+        nbatch = {
+            "obs": gather_rows(data["obs"], obs_rows),
+            "protos": gather_rows(data["protos"], proto_rows),
+            "actions": gather_rows(data["actions"], rows),
+        }
+        if self.prototype_snap:
+            if self.replay_buffer is not None:
+                # stored once per episode
+                eps_idx = np.searchsorted(
+                    self.episode_ends, self.indices[idxs, 0], side="right"
+                )
+                nbatch["proto_snap"] = gather_rows(
+                    self.replay_buffer.meta["proto_snap"], eps_idx[:, None]
+                )
+            else:
+                # duplicate. only take one
+                nbatch["proto_snap"] = data["proto_snap"][rows[:, -1:]]
+
+        if self.replay_buffer is not None:
+            # the backing store holds the raw data
+            for key in nbatch:
+                if key in self.stats:
+                    nbatch[key] = normalize_data(nbatch[key], self.stats[key])
 
         if self.obs_image_based:
-            nsample["images"] = self.transform_images(nsample["images"])
-            nsample["images"] = nsample["images"][: self.obs_horizon, :]
-            nsample["obs"] = nsample["obs"][: self.obs_horizon, :9]
+            nbatch["obs"] = nbatch["obs"][..., :9]
+            nbatch["images"] = self.transform_images(
+                gather_rows(data["images"], obs_rows)
+            )
+        return nbatch
 
-        return nsample
+    def __getitem__(self, idx):
+        nbatch = self.get_batch([idx])
+        return {key: value[0] for key, value in nbatch.items()}
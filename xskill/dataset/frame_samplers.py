@@ -15,11 +15,13 @@
 """Video frame samplers."""
 
 import abc
+import os
 import random
 from absl import logging
 
 import numpy as np
 from xskill.utility.file_utils import get_subdirs, load_image, get_files
+from xskill.utility.utils import read_json, write_json
 
 
 class FrameSampler(abc.ABC):
@@ -68,20 +70,21 @@ class FrameSampler(abc.ABC):
         frame_idxs,
         vid_len,
     ):
-        """Generate causal context frame indices for each sampled frame."""
+        """Generate causal context frame indices for each sampled frame.
+
+    Returns:
+      An int array of shape (num_frames, num_ctx_frames).
+    """
         # Currently, context idxs are sampled up to the current step, i.e. we do
         # not want to encode information from future timesteps.
-        ctx_idxs = []
-        for idx in frame_idxs:
-            idxs = list(
-                range(
-                    idx - (self._num_ctx_frames - 1) * self._ctx_stride,
-                    idx + self._ctx_stride,
-                    self._ctx_stride,
-                ))
-            idxs = np.clip(idxs, a_min=0, a_max=vid_len - 1)
-            ctx_idxs.append(idxs)
-        return ctx_idxs
+        offsets = np.arange(
+            -(self._num_ctx_frames - 1) * self._ctx_stride,
+            self._ctx_stride,
+            self._ctx_stride,
+        )
+        frame_idxs = np.asarray(frame_idxs, dtype=np.int64)
+        ctx_idxs = frame_idxs[:, None] + offsets[None, :]
+        return np.clip(ctx_idxs, a_min=0, a_max=vid_len - 1)
 
     @abc.abstractmethod
     def _sample(self, frames):
@@ -92,7 +95,7 @@ class FrameSampler(abc.ABC):
         absolute path to all the frames in a video.
 
     Returns:
-      The indices of the `frames` list to sample.
+      An int array with the indices of the `frames` list to sample.
     """
         pass
 
@@ -111,11 +114,24 @@ class FrameSampler(abc.ABC):
       vid_dirs: A list of video folder paths from which to sample frames.
 
     Returns:
-      A dict containing a list with the sampled frame indices, a list of
-      all frame paths in the video directory and a list with indices of
-      the context frames for each sampled frame.
+      A dict containing an int array with the sampled frame indices, an
+      array of all frame paths in the video directory and an int array of
+      shape (num_frames, num_ctx_frames) with the indices of the context
+      frames for each sampled frame.
     """
         frames = self._load_frames(vid_dirs)
+        return self.sample_frames(frames)
+
+    def sample_frames(self, frames):
+        """Sample from an already loaded list of frames.
+
+    Args:
+      frames: A sequence with one entry per frame of the video, e.g. the frame
+        paths or simply `np.arange(vid_len)` for packed videos.
+
+    Returns:
+      The same dict as `sample`.
+    """
         frame_idxs = self._sample(frames)
         return {
             "frames": frames,
@@ -137,10 +153,78 @@ class SingleVideoFrameSampler(FrameSampler):
     """Frame samplers that operate on a single video at a time.
 
   Subclasses should implemented the `_sample` method.
+
+  The sorted frame paths of every video are listed once and cached, so
+  `sample` does not glob the video directory on every call.
   """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._frame_index = {}
+
+    def build_frame_index(self, vid_dirs, manifest_path=None):
+        """List the frames of the given videos once and cache them.
+
+    Args:
+      vid_dirs: A list of video folder paths.
+      manifest_path: Optional path of a json manifest mapping each video
+        folder name to its sorted frame file names and the mtime of the
+        folder. Videos found in the manifest with an unchanged mtime are not
+        listed again, new or changed ones are listed and written back.
+    """
+        manifest = {}
+        if manifest_path is not None and os.path.exists(manifest_path):
+            manifest = read_json(manifest_path)
+            if manifest.get("pattern") != self._pattern:
+                manifest = {}
+        videos = manifest.get("videos", {})
+
+        updated = False
+        for vid_dir in vid_dirs:
+            vid_dir = str(vid_dir)
+            vid_name = os.path.basename(os.path.normpath(vid_dir))
+            # adding, removing or renaming frames changes the folder mtime
+            mtime = os.stat(vid_dir).st_mtime_ns
+            entry = videos.get(vid_name)
+            if not isinstance(entry, dict) or entry.get("mtime") != mtime:
+                entry = {
+                    "mtime":
+                    mtime,
+                    "frames": [
+                        f.name for f in get_files(
+                            vid_dir, self._pattern, sort_numerical=True)
+                    ],
+                }
+                videos[vid_name] = entry
+                updated = True
+            self._frame_index[vid_dir] = np.array(
+                [os.path.join(vid_dir, f) for f in entry["frames"]])
+
+        if manifest_path is not None and updated:
+            # written to a temporary file of this process first, readers never
+            # see a partial manifest and concurrent ranks do not collide
+            tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+            try:
+                write_json(tmp_path, {
+                    "pattern": self._pattern,
+                    "videos": videos
+                })
+                os.replace(tmp_path, manifest_path)
+            except OSError as e:
+                # e.g. a read-only data mount, the index stays in memory
+                logging.warning("Could not write frame index manifest %s: %s",
+                                manifest_path, e)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
     def _load_frames(self, vid_dir):
-        return get_files(vid_dir, self._pattern, sort_numerical=True)
+        vid_dir = str(vid_dir)
+        if vid_dir not in self._frame_index:
+            self._frame_index[vid_dir] = np.array([
+                str(f)
+                for f in get_files(vid_dir, self._pattern, sort_numerical=True)
+            ])
+        return self._frame_index[vid_dir]
 
 
 class StridedSampler(SingleVideoFrameSampler):
@@ -181,14 +265,8 @@ class StridedSampler(SingleVideoFrameSampler):
                 0, max(1, vid_len - self._stride * self._num_frames))
         else:
             offset = 0
-        cc_idxs = list(
-            range(
-                offset,
-                offset + self._num_frames * self._stride + 1,
-                self._stride,
-            ))
-        cc_idxs = np.clip(cc_idxs, a_min=0, a_max=vid_len - 1)
-        return cc_idxs[:self._num_frames]
+        cc_idxs = offset + np.arange(self._num_frames) * self._stride
+        return np.clip(cc_idxs, a_min=0, a_max=vid_len - 1)
 
 
 class AllSampler(StridedSampler):
@@ -267,11 +345,10 @@ class UniformSampler(SingleVideoFrameSampler):
         cond1 = vid_len >= self._offset
         cond2 = self._num_frames < (vid_len - self._offset)
         if cond1 and cond2:
-            cc_idxs = list(range(self._offset, vid_len))
-            random.shuffle(cc_idxs)
-            cc_idxs = cc_idxs[:self._num_frames]
-            return sorted(cc_idxs)
-        return list(range(0, self._num_frames))
+            cc_idxs = random.sample(range(self._offset, vid_len),
+                                    self._num_frames)
+            return np.sort(cc_idxs)
+        return np.arange(self._num_frames)
 
 class UniformDownSampleSampler(SingleVideoFrameSampler):
     """Uniformly sample video frames starting from an optional offset."""
@@ -296,17 +373,14 @@ class UniformDownSampleSampler(SingleVideoFrameSampler):
         cond1 = vid_len >= self._offset
         cond2 = self._num_frames < (vid_len - self._offset)
         if cond1 and cond2:
-            cc_idxs = list(range(self._offset, vid_len))
-            random.shuffle(cc_idxs)
-            cc_idxs = cc_idxs[:self._num_frames]
-            downsample_cc_idxs = sorted(cc_idxs)
+            downsample_cc_idxs = np.sort(
+                random.sample(range(self._offset, vid_len), self._num_frames))
         else:
-            downsample_cc_idxs = list(range(0, self._num_frames))
-            downsample_cc_idxs = np.clip(downsample_cc_idxs,
-                                        a_min=0,
-                                        a_max=vid_len - 1)
+            downsample_cc_idxs = np.clip(np.arange(self._num_frames),
+                                         a_min=0,
+                                         a_max=vid_len - 1)
 
-        return [np.array(downsample_frames[i]) for i in downsample_cc_idxs]
+        return downsample_frames[downsample_cc_idxs]
 
 class WindowSampler(SingleVideoFrameSampler):
     """Samples a contiguous window of frames."""
@@ -315,9 +389,8 @@ class WindowSampler(SingleVideoFrameSampler):
         vid_len = len(frames)
         if vid_len > self._num_frames:
             range_min = random.randrange(vid_len - self._num_frames)
-            range_max = range_min + self._num_frames
-            return list(range(range_min, range_max))
-        return list(range(0, self._num_frames))
+            return np.arange(range_min, range_min + self._num_frames)
+        return np.arange(self._num_frames)
 
 
 class UniformWithPositivesSampler(SingleVideoFrameSampler):
@@ -338,14 +411,10 @@ class UniformWithPositivesSampler(SingleVideoFrameSampler):
 
     def _sample(self, frames):
         vid_len = len(frames)
-        cc_idxs = list(range(vid_len))
-        random.shuffle(cc_idxs)
-        cc_idxs = cc_idxs[:self._num_frames]
-        pos_steps = np.asarray([
-            np.random.randint(step - self._pos_window, step + 1)
-            for step in cc_idxs
-        ])
-        return np.concatenate([sorted(pos_steps), sorted(cc_idxs)])
+        cc_idxs = np.asarray(
+            random.sample(range(vid_len), min(self._num_frames, vid_len)))
+        pos_steps = np.random.randint(cc_idxs - self._pos_window, cc_idxs + 1)
+        return np.concatenate([np.sort(pos_steps), np.sort(cc_idxs)])
 
 
 
@@ -359,23 +428,15 @@ class SingleZarrVideoFrameSampler(FrameSampler):
         pass
 
     def sample(self, frames):
-        """Sample the frames in a video directory.
+        """Sample the frames of a video stored in a zarr array.
 
     Args:
-      vid_dirs: A list of video folder paths from which to sample frames.
+      frames: `np.arange(eps_len)` of the episode to sample from.
 
     Returns:
-      A dict containing a list with the sampled frame indices, a list of
-      all frame paths in the video directory and a list with indices of
-      the context frames for each sampled frame.
+      The same dict as `FrameSampler.sample_frames`.
     """
-        frame_idxs = self._sample(frames)
-        return {
-            "frames": frames,
-            "frame_idxs": frame_idxs,
-            "vid_len": len(frames),
-            "ctx_idxs": self._get_context_steps(frame_idxs, len(frames)),
-        }
+        return self.sample_frames(frames)
 
 
 class ZarrUniformSampler(SingleZarrVideoFrameSampler):
@@ -399,11 +460,10 @@ class ZarrUniformSampler(SingleZarrVideoFrameSampler):
         cond1 = vid_len >= self._offset
         cond2 = self._num_frames < (vid_len - self._offset)
         if cond1 and cond2:
-            cc_idxs = list(range(self._offset, vid_len))
-            random.shuffle(cc_idxs)
-            cc_idxs = cc_idxs[:self._num_frames]
-            return sorted(cc_idxs)
-        return list(range(0, self._num_frames))
+            cc_idxs = random.sample(range(self._offset, vid_len),
+                                    self._num_frames)
+            return np.sort(cc_idxs)
+        return np.arange(self._num_frames)
 
 
 class ZarrAllSampler(SingleZarrVideoFrameSampler):
@@ -423,7 +483,7 @@ class ZarrAllSampler(SingleZarrVideoFrameSampler):
         self._offset = offset
 
     def _sample(self, frames):
-        return list(range(0, len(frames)))
+        return np.arange(len(frames))
 
 
 class ZarrFrequencySampler(SingleZarrVideoFrameSampler):
@@ -444,7 +504,7 @@ class ZarrFrequencySampler(SingleZarrVideoFrameSampler):
         self.frequency = frequency
 
     def _sample(self, frames):
-        return list(range(0, len(frames)))[::self.frequency]
+        return np.arange(0, len(frames), self.frequency)
 
 
 class ZarrFrequencyUniformSampler(SingleZarrVideoFrameSampler):
@@ -465,18 +525,15 @@ class ZarrFrequencyUniformSampler(SingleZarrVideoFrameSampler):
         self.frequency = frequency
 
     def _sample(self, frames):
-        frequency_frames = frames[::self.frequency]
+        frequency_frames = np.arange(0, len(frames), self.frequency)
         vid_len = len(frequency_frames)
         cond1 = vid_len >= self._offset
         cond2 = self._num_frames < (vid_len - self._offset)
         if cond1 and cond2:
-            cc_idxs = list(range(self._offset, vid_len))
-            random.shuffle(cc_idxs)
-            cc_idxs = cc_idxs[:self._num_frames]
-            frequency_cc_idxs = sorted(cc_idxs)
+            frequency_cc_idxs = np.sort(
+                random.sample(range(self._offset, vid_len), self._num_frames))
         else:
-            frequency_cc_idxs = list(range(0, self._num_frames))
-            frequency_cc_idxs = np.clip(frequency_cc_idxs,
+            frequency_cc_idxs = np.clip(np.arange(self._num_frames),
                                         a_min=0,
                                         a_max=vid_len - 1)
-        return [np.array(frequency_frames[i]) for i in frequency_cc_idxs]
\ No newline at end of file
+        return frequency_frames[frequency_cc_idxs]
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""Packed per-episode frame store.
+
+Each episode folder of PNG frames (``kitchen_dataset/{robot,human}/<eps>``) is
+converted once into a single pre-resized uint8 ``.npy`` array stored next to
+the frames. Datasets then memory-map the array and slice frames out of it
+instead of decoding one PNG per sampled frame.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from xskill.utility.file_utils import get_files, load_image
+
+
+def get_packed_frames_path(vid_dir, resize_shape=None):
+    """Return the path of the packed frame array of a video folder.
+
+  Args:
+    vid_dir: The episode folder containing the PNG frames.
+    resize_shape: The (width, height) the frames were resized to, or None if
+      they are stored at their original resolution.
+
+  Returns:
+    The path to the `.npy` file.
+  """
+    if resize_shape is None:
+        name = "frames.npy"
+    else:
+        name = f"frames_{int(resize_shape[0])}x{int(resize_shape[1])}.npy"
+    return os.path.join(str(vid_dir), name)
+
+
+def pack_video_frames(vid_dir,
+                      resize_shape=None,
+                      pattern="*.png",
+                      overwrite=False):
+    """Pack all frames of a video folder into a single uint8 array file.
+
+  The frames are resized exactly like `EpisodeTrajDataset` does at load time
+  so the packed and the PNG code paths return identical arrays.
+
+  Args:
+    vid_dir: The episode folder containing the PNG frames.
+    resize_shape: The (width, height) to resize the frames to.
+    pattern: The wildcard pattern for the video frames.
+    overwrite: Repack even if the packed file already exists.
+
+  Returns:
+    The path to the packed file.
+  """
+    out_path = get_packed_frames_path(vid_dir, resize_shape)
+    if os.path.exists(out_path) and not overwrite:
+        return out_path
+
+    frames = []
+    for frame_path in get_files(vid_dir, pattern, sort_numerical=True):
+        frame = load_image(frame_path)
+        if resize_shape is not None:
+            frame = cv2.resize(frame, tuple(resize_shape))
+        frames.append(frame)
+    frames = np.stack(frames)  # (T,h,w,c)
+    assert frames.dtype == np.uint8
+
+    # write to a temporary file first so that an interrupted pack never
+    # leaves a truncated array behind
+    tmp_path = out_path + ".tmp.npy"
+    np.save(tmp_path, frames)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def load_packed_frames(vid_dir, resize_shape=None):
+    """Memory-map the packed frame array of a video folder.
+
+  Returns:
+    A read-only (T,h,w,c) uint8 array backed by the packed file.
+  """
+    return np.load(get_packed_frames_path(vid_dir, resize_shape),
+                   mmap_mode="r")
@@ -9,7 +9,7 @@ from xskill.common.replay_buffer import ReplayBuffer
 from xskill.common.sampler import SequenceSampler, get_val_mask
 from xskill.model.common.normalizer import LinearNormalizer, SingleFieldLinearNormalizer
 from xskill.dataset.base_dataset import BaseLowdimDataset
-from xskill.env.kitchen.kitchen_util import parse_mjl_logs
+from xskill.env.kitchen.kitchen_util import parse_mjl_logs_batch
 
 
 class KitchenMjlLowdimDataset(BaseLowdimDataset):
@@ -22,7 +22,8 @@ class KitchenMjlLowdimDataset(BaseLowdimDataset):
                  abs_action=True,
                  robot_noise_ratio=0.0,
                  seed=42,
-                 val_ratio=0.0):
+                 val_ratio=0.0,
+                 num_workers=None):
         super().__init__()
 
         if not abs_action:
@@ -39,9 +40,15 @@ class KitchenMjlLowdimDataset(BaseLowdimDataset):
         data_directory = pathlib.Path(dataset_dir)
         self.replay_buffer = ReplayBuffer.create_empty_numpy()
         data_list= sorted(list(data_directory.glob('*/*.mjl')))
-        for i, mjl_path in enumerate(tqdm(data_list)):
+        # parsed in num_workers processes, 0 parses in this process
+        parsed_list = parse_mjl_logs_batch(
+            [mjl_path.absolute() for mjl_path in data_list],
+            skipamount=40,
+            num_workers=num_workers)
+        for i, data in enumerate(tqdm(parsed_list)):
             try:
-                data = parse_mjl_logs(str(mjl_path.absolute()), skipamount=40)
+                if isinstance(data, Exception):
+                    raise data
                 qpos = data['qpos'].astype(np.float32)
                 obs = np.concatenate([
                     qpos[:, :9], qpos[:, -21:],
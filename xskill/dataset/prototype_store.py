@@ -0,0 +1,158 @@
+"""Columnar store for the prototypes labeled by a pretrained skill model.
+
+Every key of all episodes of one embodiment is concatenated into a single
+float32 array of ``prototype.zarr`` inside the prototype folder, e.g.
+``{exp_path}/encode_protos/ckpt_{ckpt}/prototype.zarr``. Like the real world
+``prototype.zarr``, ``eps_end`` marks one-past the last row of each episode.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import zarr
+
+PROTOTYPE_STORE_NAME = "prototype.zarr"
+
+# keys with one row per frame
+FRAME_KEYS = ("prototypes", "softmax_prototypes", "raw_rep", "moved_obj")
+# one row per sliding window, i.e. slide rows less than the frame keys
+WINDOW_KEYS = ("affordance_state_embs", )
+
+# name of the per episode json files of the former layout
+JSON_NAMES = {
+    "prototypes": "encode_protos.json",
+    "softmax_prototypes": "softmax_encode_protos.json",
+    "raw_rep": "traj_representation.json",
+    "moved_obj": "moved_obj.json",
+    "affordance_state_embs": "affordance_state_embs.json",
+}
+
+
+def get_prototype_store_path(proto_dir):
+    return os.path.join(str(proto_dir), PROTOTYPE_STORE_NAME)
+
+
+def has_prototype_store(proto_dir):
+    return os.path.isdir(get_prototype_store_path(proto_dir))
+
+
+class PrototypeStoreWriter:
+    """
+    Appends labeled episodes to a new prototype store. The store is written
+    to a temporary folder and moved in place by close(), so readers never see
+    a partially labeled store.
+    """
+
+    def __init__(self, proto_dir, chunk_rows=4096):
+        os.makedirs(proto_dir, exist_ok=True)
+        self.path = get_prototype_store_path(proto_dir)
+        self.tmp_path = self.path + ".tmp"
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        self.root = zarr.open_group(self.tmp_path, mode="w")
+        self.chunk_rows = chunk_rows
+        self.episode_ids = []
+        self.eps_len = []
+        self.window_len = []
+
+    def _append(self, key, data):
+        if key not in self.root:
+            self.root.zeros(key,
+                            shape=(0, ) + data.shape[1:],
+                            chunks=(self.chunk_rows, ) + data.shape[1:],
+                            dtype=data.dtype,
+                            compressor=None)
+        self.root[key].append(data)
+
+    def add_episodes(self, episode_ids, episodes):
+        """
+        episode_ids: episode folder names (int)
+        episodes: one dict per episode of the FRAME_KEYS and WINDOW_KEYS
+            arrays, all keys of every episode are appended in one write
+        """
+        for key in FRAME_KEYS + WINDOW_KEYS:
+            if key not in episodes[0]:
+                continue
+            dtype = np.int32 if key == "moved_obj" else np.float32
+            self._append(
+                key,
+                np.concatenate([np.asarray(e[key], dtype=dtype)
+                                for e in episodes]))
+        self.episode_ids.extend(int(i) for i in episode_ids)
+        self.eps_len.extend(len(e["prototypes"]) for e in episodes)
+        if "affordance_state_embs" in episodes[0]:
+            self.window_len.extend(
+                len(e["affordance_state_embs"]) for e in episodes)
+
+    def close(self):
+        self.root.array("episode_ids",
+                        np.asarray(self.episode_ids, dtype=np.int64))
+        self.root.array("eps_end", np.cumsum(self.eps_len, dtype=np.int64))
+        if len(self.window_len) > 0:
+            self.root.array("window_eps_end",
+                            np.cumsum(self.window_len, dtype=np.int64))
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+
+class PrototypeStore:
+    """
+    Read access to the episodes of a prototype store. Only the episode index
+    is loaded up front, episodes are sliced out of the arrays on demand.
+    """
+
+    def __init__(self, proto_dir):
+        self.root = zarr.open_group(get_prototype_store_path(proto_dir),
+                                    mode="r")
+        episode_ids = self.root["episode_ids"][:]
+        self._index = {
+            int(eps_id): i
+            for i, eps_id in enumerate(episode_ids)
+        }
+        self._ends = {"eps_end": self.root["eps_end"][:]}
+        if "window_eps_end" in self.root:
+            self._ends["window_eps_end"] = self.root["window_eps_end"][:]
+
+    def __contains__(self, episode_id):
+        return int(episode_id) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, episode_id, key):
+        """
+        returns the (T,D) rows of key for one episode, T is the episode length
+            for FRAME_KEYS and the number of windows for WINDOW_KEYS
+        """
+        i = self._index[int(episode_id)]
+        ends = self._ends["window_eps_end" if key in WINDOW_KEYS else "eps_end"]
+        start = 0 if i == 0 else ends[i - 1]
+        return self.root[key][start:ends[i]]
+
+    def get_all(self, key):
+        """ rows of key of all episodes, concatenated in insertion order """
+        return self.root[key][:]
+
+
+def load_prototypes(proto_dir, episode_id, key):
+    """
+    Load one key of one episode from the prototype store of proto_dir, or
+    from the per episode json files of folders labeled before the store.
+    key can be a list of keys, the store is then opened once and a list of
+    arrays is returned.
+    """
+    keys = [key] if isinstance(key, str) else list(key)
+    if has_prototype_store(proto_dir):
+        store = PrototypeStore(proto_dir)
+        data = [store.get(episode_id, k) for k in keys]
+    else:
+        data = []
+        for k in keys:
+            json_path = os.path.join(str(proto_dir), str(episode_id),
+                                     JSON_NAMES[k])
+            with open(json_path, "r") as f:
+                data.append(np.array(json.load(f), dtype=np.float32))
+    return data[0] if isinstance(key, str) else data
@@ -1,5 +1,4 @@
 import collections
-import concurrent.futures
 import random
 from collections import namedtuple
 
@@ -9,6 +8,7 @@ import torch
 
 from xskill.dataset.real_data_conversion import \
     real_data_to_replay_buffer
+from xskill.dataset.decode_pool import map_in_pool, resolve_num_threads
 
 IndexBatch = namedtuple("IndexBatch", "im_q index info")
 
@@ -25,7 +25,15 @@ class RealWorldEpisodeTrajDataset(torch.utils.data.Dataset):
         max_get_threads=4,
         read_top_n=None,
         resize_shape=[320, 240],
+        num_workers=0,
+        uint8_output=False,
     ) -> None:
+        """
+        uint8_output: return the raw uint8 (T,h,w,c) frames and leave the
+            permute and scaling to Model.on_after_batch_transfer on device.
+        max_get_threads: decode threads per DataLoader worker. None splits the
+            cpu cores evenly between the num_workers DataLoader workers.
+        """
         super().__init__()
         self._frame_sampler = frame_sampler
         self.resize_shape = resize_shape
@@ -44,7 +52,9 @@ class RealWorldEpisodeTrajDataset(torch.utils.data.Dataset):
         self._indexfile = {}
         self._build_dir_tree()
         self.camera_name = camera_name
-        self.max_get_threads = max_get_threads
+        self.max_get_threads = resolve_num_threads(max_get_threads,
+                                                   num_workers)
+        self.uint8_output = uint8_output
 
     def seed_rng(self):
         if self._seed:
@@ -68,35 +78,21 @@ class RealWorldEpisodeTrajDataset(torch.utils.data.Dataset):
                            eps_begin,
                            eps_len,
                            resize_shape=None):
-        sample_index = list(np.array(sample['ctx_idxs']).flatten() + eps_begin)
-        frames = [None for _ in range(len(sample['ctx_idxs']))]
-
-        def get_image(image_index, sample_index, frames, image_zarr,
-                      resize_shape):
-            try:
-                if resize_shape is not None:
-                    frame = image_zarr[sample_index]
-                    resized_frames = cv2.resize(frame, resize_shape)
-                    frames[image_index] = resized_frames
-                else:
-                    frames[image_index] = image_zarr[sample_index]
-                return True
-            except Exception as e:
-                return False
-
-        with concurrent.futures.ThreadPoolExecutor(
-                max_workers=self.max_get_threads) as executor:
-            futures = set()
-            for i, idx in enumerate(sample_index):
-                futures.add(
-                    executor.submit(get_image, i, idx, frames, image_zarr,
-                                    resize_shape))
-
-            completed, futures = concurrent.futures.wait(futures)
-            for f in completed:
-                if not f.result():
-                    raise RuntimeError('Failed to get image!')
-
+        sample_index = sample['ctx_idxs'].ravel() + eps_begin
+
+        def get_images(sample_index):
+            frames = []
+            for idx in sample_index:
+                try:
+                    frame = image_zarr[idx]
+                    if resize_shape is not None:
+                        frame = cv2.resize(frame, resize_shape)
+                except Exception as e:
+                    raise RuntimeError('Failed to get image!') from e
+                frames.append(frame)
+            return frames
+
+        frames = map_in_pool(get_images, sample_index, self.max_get_threads)
         sequence_data = np.stack(frames)  # Shape: (S * X, H, W, C)
         return sequence_data
 
@@ -135,6 +131,9 @@ class RealWorldEpisodeTrajDataset(torch.utils.data.Dataset):
 
     # # @profile
     def transform(self, sequence_data):
+        if self.uint8_output:
+            # (T,h,w,dim) uint8, a quarter of the bytes of float32
+            return np.ascontiguousarray(sequence_data)
         # Horig, Worig = sequence_data.shape[1:3]
         sequence_data = np.transpose(sequence_data, (0, 3, 1, 2)).astype(
             np.float32)  # (T,dim,h,w)
@@ -0,0 +1,253 @@
+"""Render the kitchen demonstrations into per episode image folders or into
+a zarr ReplayBuffer.
+
+The mjl logs are parsed once in the parent process. Workers are forked from
+it, so they share the replay buffer read-only, and each worker creates its
+kitchen env once. Episodes are handed out one at a time, longest first, so a
+long episode never holds back a static shard of short ones.
+"""
+
+import concurrent.futures
+import json
+import multiprocessing
+import os
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from xskill.codecs.imagecodecs_numcodecs import Jpeg2k, register_codecs
+from xskill.common.replay_buffer import ReplayBuffer
+from xskill.env.kitchen.v0 import KitchenAllV0
+
+register_codecs()
+
+# state of the worker processes, set by _init_worker
+_worker = dict()
+
+
+def create_render_env(embodiment):
+    if embodiment == 'robot':
+        env = KitchenAllV0(use_abs_action=True, use_sphere_agent=False)
+    elif embodiment == 'human':
+        env = KitchenAllV0(use_abs_action=True, use_sphere_agent=True)
+    else:
+        raise NotImplementedError
+    env.reset()
+    return env
+
+
+def render_states(env, obs, res):
+    """
+    Reset the robot and objects to every recorded state and render it.
+    obs: (T,obs_dim) recorded observations, qpos in the first 30 dims
+    returns (T,res,res,3) uint8 frames
+    """
+    frames = np.empty((len(obs), res, res, 3), dtype=np.uint8)
+    for i in range(len(obs)):
+        reset_pos = np.concatenate([obs[i, :9], obs[i, 9:30]])
+        env.robot.reset(env, reset_pos, env.init_qvel[:].copy())
+        env.render(width=res, height=res, out=frames[i])
+    return frames
+
+
+def dump_json(data, path):
+    # written to a temporary file first, a killed run leaves no partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def is_episode_rendered(save_dir, eps_idx):
+    # states.json is written last
+    return os.path.isfile(os.path.join(save_dir, f'{eps_idx}', 'states.json'))
+
+
+def _init_worker(replay_buffer, embodiment, res):
+    _worker['replay_buffer'] = replay_buffer
+    _worker['env'] = create_render_env(embodiment)
+    _worker['res'] = res
+
+
+def _render_episode(eps_idx, save_dir):
+    eps_data = _worker['replay_buffer'].get_episode(eps_idx)
+    frames = render_states(_worker['env'], eps_data['obs'], _worker['res'])
+    if save_dir is None:
+        # written by the parent process
+        return eps_idx, frames
+
+    save_folder = os.path.join(save_dir, f'{eps_idx}')
+    os.makedirs(save_folder, exist_ok=True)
+    for i, frame in enumerate(frames):
+        Image.fromarray(frame).save(os.path.join(save_folder, f'{i}.png'))
+    dump_json(eps_data['action'].tolist(),
+              os.path.join(save_folder, 'actions.json'))
+    dump_json(eps_data['obs'].tolist(),
+              os.path.join(save_folder, 'states.json'))
+    return eps_idx, None
+
+
+class RenderStoreWriter:
+    """
+    Appends rendered episodes to a zarr ReplayBuffer with 'images', 'obs' and
+    'action' arrays. Episodes are stored in the order they finish rendering,
+    meta/episode_ids holds the mjl episode index of every stored episode.
+    Frames are compressed by a thread pool, one chunk per write, like
+    real_data_to_replay_buffer. Reopening an existing store resumes it.
+    """
+
+    def __init__(self,
+                 path,
+                 image_compressor=None,
+                 image_chunk_frames=1,
+                 num_write_threads=None):
+        """
+        image_compressor: numcodecs codec of the images, Jpeg2k(level=50) by
+            default. Image codecs encode single frames, they need
+            image_chunk_frames=1.
+        image_chunk_frames: frames per image chunk
+        num_write_threads: threads compressing image chunks
+        """
+        if image_compressor is None:
+            image_compressor = Jpeg2k(level=50)
+        self.image_compressor = image_compressor
+        self.image_chunk_frames = image_chunk_frames
+        self.replay_buffer = ReplayBuffer.create_from_path(path, mode='a')
+        meta = self.replay_buffer.meta
+        if 'episode_ids' not in meta:
+            meta.zeros('episode_ids',
+                       shape=(0, ),
+                       dtype=np.int64,
+                       compressor=None)
+        # the id is written before the episode, drop the id of an episode
+        # that did not finish writing
+        episode_ids = meta['episode_ids']
+        episode_ids.resize(self.replay_buffer.n_episodes)
+        self.episode_ids = set(int(i) for i in episode_ids[:])
+        self.thread_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_write_threads)
+
+    def _images(self, frame_shape):
+        data = self.replay_buffer.data
+        if 'images' not in data:
+            data.zeros('images',
+                       shape=(0, ) + frame_shape,
+                       chunks=(self.image_chunk_frames, ) + frame_shape,
+                       dtype=np.uint8,
+                       compressor=self.image_compressor)
+        return data['images']
+
+    def add_episode(self, eps_idx, eps_data, frames):
+        """
+        eps_data: dict of the episode 'obs' and 'action'
+        frames: (T,h,w,3) uint8 rendered frames
+        """
+        start = self.replay_buffer.n_steps
+        end = start + len(frames)
+        images = self._images(frames.shape[1:])
+        images.resize((end, ) + frames.shape[1:])
+        # split at the chunk borders, every write encodes its own chunk
+        chunk = self.image_chunk_frames
+        first_border = -(-start // chunk) * chunk
+        borders = sorted(
+            set([start, end] + list(range(first_border, end, chunk))))
+
+        def put_frames(bounds):
+            images[bounds[0]:bounds[1]] = frames[bounds[0] - start:bounds[1] -
+                                                 start]
+
+        list(self.thread_pool.map(put_frames, zip(borders[:-1], borders[1:])))
+
+        self.replay_buffer.meta['episode_ids'].append([eps_idx])
+        # episode_ends is extended last, it commits the episode
+        self.replay_buffer.add_episode({
+            'obs': eps_data['obs'],
+            'action': eps_data['action']
+        })
+        self.episode_ids.add(int(eps_idx))
+
+    def close(self):
+        self.thread_pool.shutdown()
+
+
+def open_render_store(cfg):
+    """
+    RenderStoreWriter of cfg.zarr_path if cfg.output is zarr, None for png
+    folders, cfg as in config/simulation/create_kitchen_dataset.yaml
+    """
+    if cfg.output == 'png':
+        return None
+    elif cfg.output == 'zarr':
+        return RenderStoreWriter(
+            cfg.zarr_path,
+            image_compressor=Jpeg2k(level=cfg.image_compressor_level),
+            image_chunk_frames=cfg.image_chunk_frames,
+            num_write_threads=cfg.num_write_threads)
+    else:
+        raise NotImplementedError
+
+
+def render_episodes(replay_buffer,
+                    episode_idxs,
+                    embodiment,
+                    save_dir=None,
+                    res=384,
+                    num_workers=None,
+                    overwrite=False,
+                    store=None):
+    """
+    Render the episodes episode_idxs of replay_buffer to
+    save_dir/<eps_idx>/{<i>.png,actions.json,states.json}, or append them to
+    store, a RenderStoreWriter, if given.
+    Episodes rendered by an earlier run are skipped unless overwrite.
+    """
+    if store is not None:
+        if overwrite:
+            raise ValueError('overwrite is not supported for a render store')
+        episode_idxs = [int(i) for i in episode_idxs
+                        if int(i) not in store.episode_ids]
+    else:
+        episode_idxs = [
+            int(i) for i in episode_idxs
+            if overwrite or not is_episode_rendered(save_dir, i)
+        ]
+    if len(episode_idxs) == 0:
+        return
+    episode_lengths = replay_buffer.episode_lengths
+    # longest first, the short ones fill the gaps at the end
+    episode_idxs.sort(key=lambda i: -episode_lengths[i])
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    # bounds the rendered episodes waiting to be written by the parent
+    max_pending = 2 * num_workers
+    # forked workers inherit the replay buffer instead of unpickling it
+    ctx = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(replay_buffer, embodiment, res)) as executor, tqdm(
+                total=len(episode_idxs),
+                desc=f'Rendering {embodiment}') as pbar:
+        todo = iter(episode_idxs)
+        pending = set()
+        while True:
+            for eps_idx in todo:
+                pending.add(
+                    executor.submit(_render_episode, eps_idx,
+                                    None if store is not None else save_dir))
+                if len(pending) >= max_pending:
+                    break
+            if len(pending) == 0:
+                break
+            finished, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                eps_idx, frames = future.result()
+                if store is not None:
+                    store.add_episode(eps_idx,
+                                      replay_buffer.get_episode(eps_idx),
+                                      frames)
+                pbar.update(1)
@@ -1,36 +1,49 @@
+import concurrent.futures
+import os
 import struct
 import numpy as np
 
+MJL_HEADER_SIZE = 28
+
+
+def mjl_record_dtype(nq, nv, nu, nmocap, nsensordata, nuserdata):
+    """Structured dtype of one float32 record of a mjl log."""
+    return np.dtype([
+        ('time', '<f4'),
+        ('qpos', '<f4', (nq, )),
+        ('qvel', '<f4', (nv, )),
+        ('ctrl', '<f4', (nu, )),
+        ('mocap_pos', '<f4', (3 * nmocap, )),
+        ('mocap_quat', '<f4', (4 * nmocap, )),
+        ('sensordata', '<f4', (nsensordata, )),
+        ('userdata', '<f4', (nuserdata, )),
+    ])
+
+
 def parse_mjl_logs(read_filename, skipamount):
+    """
+    The log is memory mapped with one structured record per step, time, qpos,
+    qvel, ctrl, mocap_pos, mocap_quat, sensordata and userdata are float32
+    views of every skipamount-th record, nothing is copied until they are
+    used.
+    """
     with open(read_filename, mode='rb') as file:
-        fileContent = file.read()
-    headers = struct.unpack('iiiiiii', fileContent[:28])
-    nq = headers[0]
-    nv = headers[1]
-    nu = headers[2]
-    nmocap = headers[3]
-    nsensordata = headers[4]
-    nuserdata = headers[5]
-    name_len = headers[6]
-    name = struct.unpack(str(name_len) + 's', fileContent[28:28+name_len])[0]
-    rem_size = len(fileContent[28 + name_len:])
-    num_floats = int(rem_size/4)
-    dat = np.asarray(struct.unpack(str(num_floats) + 'f', fileContent[28+name_len:]))
-    recsz = 1 + nq + nv + nu + 7*nmocap + nsensordata + nuserdata
-    if rem_size % recsz != 0:
-        print("ERROR")
-    else:
-        dat = np.reshape(dat, (int(len(dat)/recsz), recsz))
-        dat = dat.T
-
-    time = dat[0,:][::skipamount] - 0*dat[0, 0]
-    qpos = dat[1:nq + 1, :].T[::skipamount, :]
-    qvel = dat[nq+1:nq+nv+1,:].T[::skipamount, :]
-    ctrl = dat[nq+nv+1:nq+nv+nu+1,:].T[::skipamount,:]
-    mocap_pos = dat[nq+nv+nu+1:nq+nv+nu+3*nmocap+1,:].T[::skipamount, :]
-    mocap_quat = dat[nq+nv+nu+3*nmocap+1:nq+nv+nu+7*nmocap+1,:].T[::skipamount, :]
-    sensordata = dat[nq+nv+nu+7*nmocap+1:nq+nv+nu+7*nmocap+nsensordata+1,:].T[::skipamount,:]
-    userdata = dat[nq+nv+nu+7*nmocap+nsensordata+1:,:].T[::skipamount,:]
+        headers = struct.unpack('iiiiiii', file.read(MJL_HEADER_SIZE))
+        nq, nv, nu, nmocap, nsensordata, nuserdata, name_len = headers
+        name = file.read(name_len)
+    record = mjl_record_dtype(nq, nv, nu, nmocap, nsensordata, nuserdata)
+    offset = MJL_HEADER_SIZE + name_len
+    rem_size = os.path.getsize(read_filename) - offset
+    if rem_size % record.itemsize != 0:
+        raise ValueError(f'{read_filename}: {rem_size} bytes of records are '
+                         f'not a multiple of the record size '
+                         f'{record.itemsize}')
+    dat = np.memmap(read_filename,
+                    dtype=record,
+                    mode='r',
+                    offset=offset,
+                    shape=(rem_size // record.itemsize, ))
+    dat = dat[::skipamount]
 
     data = dict(nq=nq,
                nv=nv,
@@ -38,14 +51,44 @@ def parse_mjl_logs(read_filename, skipamount):
                nmocap=nmocap,
                nsensordata=nsensordata,
                name=name,
-               time=time,
-               qpos=qpos,
-               qvel=qvel,
-               ctrl=ctrl,
-               mocap_pos=mocap_pos,
-               mocap_quat=mocap_quat,
-               sensordata=sensordata,
-               userdata=userdata,
                logName = read_filename
                )
+    for field in record.names:
+        data[field] = dat[field]
     return data
+
+
+def _parse_mjl_logs_or_error(read_filename, skipamount, copy=False):
+    try:
+        data = parse_mjl_logs(read_filename, skipamount)
+    except Exception as e:
+        return e
+    if copy:
+        # in a worker, only the kept records are sent back
+        data = {
+            k: np.array(v) if isinstance(v, np.ndarray) else v
+            for k, v in data.items()
+        }
+    return data
+
+
+def parse_mjl_logs_batch(read_filenames, skipamount, num_workers=None):
+    """
+    parse_mjl_logs of every file in a process pool, in the order of
+    read_filenames. The entry of a file that failed to parse is its
+    exception. num_workers=0 parses in this process.
+    """
+    read_filenames = [str(f) for f in read_filenames]
+    if num_workers == 0:
+        return [
+            _parse_mjl_logs_or_error(f, skipamount) for f in read_filenames
+        ]
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    n = len(read_filenames)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers) as executor:
+        return list(
+            executor.map(_parse_mjl_logs_or_error,
+                         read_filenames, [skipamount] * n, [True] * n,
+                         chunksize=max(1, n // (4 * num_workers))))
@@ -15,6 +15,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import os
 import numpy as np
 from adept_envs import robot_env
@@ -207,21 +208,58 @@ class KitchenTaskRelaxV1(KitchenV0):
         score = 0.
         return reward_dict, score
 
-    def render(self, mode='human', width=1280, height=720, custom=True, **kwargs):
-        if custom:
+    # offscreen cameras kept by render, least recently used ones are freed
+    MAX_CACHED_CAMERAS = 4
+    DEFAULT_CAMERA_POSE = {
+        'distance': 2.2,
+        'lookat': [-0.2, .5, 2.],
+        'azimuth': 70,
+        'elevation': -35,
+    }
+
+    def _get_camera(self, width, height, pose):
+        """Returns a MovableCamera set to pose, reused across render calls."""
+        if not hasattr(self, '_cameras'):
+            self._cameras = collections.OrderedDict()
+        key = (width, height, tuple(
+            (k, tuple(np.ravel(v))) for k, v in sorted(pose.items())))
+        camera = self._cameras.get(key)
+        if camera is None:
             camera = engine.MovableCamera(self.sim, height, width)
-            if 'distance' not in kwargs:
-                kwargs['distance'] = 2.2
-            if 'lookat' not in kwargs:
-                kwargs['lookat'] = [-0.2, .5, 2.]
-            if 'azimuth' not in kwargs:
-                kwargs['azimuth'] = 70
-            if 'elevation' not in kwargs:
-                kwargs['elevation'] = -35
-            camera.set_pose(**kwargs)
+            camera.set_pose(**pose)
+            self._cameras[key] = camera
+            if len(self._cameras) > self.MAX_CACHED_CAMERAS:
+                _, evicted = self._cameras.popitem(last=False)
+                evicted._scene.free()  # pylint: disable=protected-access
+        else:
+            self._cameras.move_to_end(key)
+        return camera
+
+    def render(self, mode='human', width=1280, height=720, custom=True,
+               out=None, **kwargs):
+        """Renders the environment.
+
+        Args:
+            custom: Render with the kitchen camera, kwargs override its pose
+                (distance, lookat, azimuth, elevation).
+            out: Optional (height, width, 3) uint8 array, e.g. a slice of a
+                batch buffer, the custom image is written into it.
+        """
+        if custom:
+            pose = dict(self.DEFAULT_CAMERA_POSE, **kwargs)
+            camera = self._get_camera(width, height, pose)
+            # a view of the camera buffer, overwritten by the next render
             img = camera.render()
-            return img
+            if out is None:
+                return img.copy()
+            np.copyto(out, img)
+            return out
         else:
             return super(KitchenTaskRelaxV1, self).render(
                 mode=mode, width=width, height=height, **kwargs)
 
+    def close(self):
+        for camera in getattr(self, '_cameras', {}).values():
+            camera._scene.free()  # pylint: disable=protected-access
+        self._cameras = collections.OrderedDict()
+        super(KitchenTaskRelaxV1, self).close()
@@ -0,0 +1,147 @@
+"""Kitchen environments stepped in subprocess workers for batched evaluation."""
+
+import multiprocessing
+import random
+
+import cv2
+import numpy as np
+
+
+def _worker(remote, parent_remote, env_fn, render_size, resize_shape,
+            record_size, record_stride):
+    parent_remote.close()
+    env = env_fn()
+
+    if resize_shape is None:
+        frame_shape = (render_size, render_size, 3)
+    else:
+        frame_shape = (resize_shape[1], resize_shape[0], 3)
+
+    def render(out):
+        # the env renders into out, a frame of the reply buffer
+        if render_size is None:
+            env.render(width=resize_shape[0], height=resize_shape[1], out=out)
+        elif resize_shape is None:
+            env.render(width=render_size, height=render_size, out=out)
+        else:
+            image = env.render(width=render_size, height=render_size)
+            out[:] = cv2.resize(image, tuple(resize_shape))
+        return out
+
+    step = 0
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "reset":
+                # same global seeding as the serial evaluation
+                np.random.seed(data)
+                random.seed(data)
+                obs = env.reset()
+                step = 0
+                remote.send((obs, render(np.empty(frame_shape, np.uint8))))
+            elif cmd == "step":
+                # an action chunk, executed without replanning
+                obs, rewards, completed_tasks, records = [], [], [], []
+                images = np.empty((len(data), ) + frame_shape, np.uint8)
+                done = False
+                for i, action in enumerate(data):
+                    o, reward, d, info = env.step(action)
+                    obs.append(o)
+                    rewards.append(reward)
+                    completed_tasks.append(set(info["completed_tasks"]))
+                    render(images[i])
+                    if record_size is not None and step % record_stride == 0:
+                        records.append(
+                            env.render(width=record_size, height=record_size))
+                    step += 1
+                    # the done of the last step, like the serial evaluation
+                    done = d
+                remote.send((np.stack(obs), rewards, done, completed_tasks,
+                             images, records))
+            elif cmd == "close":
+                break
+            else:
+                raise NotImplementedError(cmd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+class KitchenVectorEnv:
+    """
+    num_envs environments, each in its own worker process. Workers render
+    and resize their own frames, so only the small policy inputs cross the
+    process boundary. Commands are sent to all selected workers before any
+    reply is read, so the environments step in parallel.
+    """
+
+    def __init__(self,
+                 env_fn,
+                 num_envs,
+                 render_size=384,
+                 resize_shape=None,
+                 record_size=None,
+                 record_stride=1,
+                 context="spawn"):
+        """
+        env_fn: picklable callable creating one environment,
+            e.g. functools.partial(KitchenAllV0, use_abs_action=True)
+        render_size: width and height of the rendered frames, None renders
+            them at resize_shape
+        resize_shape: (w,h) cv2 resize of the rendered frames
+        record_size: width and height of the extra frames rendered for
+            recording every record_stride-th step, None renders none
+        context: multiprocessing start method, spawn keeps the workers
+            free of the CUDA and rendering state of the parent
+        """
+        self.num_envs = num_envs
+        ctx = multiprocessing.get_context(context)
+        self.remotes, work_remotes = zip(
+            *[ctx.Pipe() for _ in range(num_envs)])
+        self.processes = []
+        for work_remote, remote in zip(work_remotes, self.remotes):
+            process = ctx.Process(target=_worker,
+                                  args=(work_remote, remote, env_fn,
+                                        render_size, resize_shape,
+                                        record_size, record_stride),
+                                  daemon=True)
+            process.start()
+            work_remote.close()
+            self.processes.append(process)
+        self.closed = False
+
+    def _call(self, cmd, data, env_ids):
+        for env_id, d in zip(env_ids, data):
+            self.remotes[env_id].send((cmd, d))
+        return [self.remotes[env_id].recv() for env_id in env_ids]
+
+    def reset(self, seeds, env_ids=None):
+        """
+        seeds: one seed per environment of env_ids
+        returns list of (obs, image) per environment
+        """
+        if env_ids is None:
+            env_ids = range(len(seeds))
+        return self._call("reset", seeds, env_ids)
+
+    def step(self, actions, env_ids=None):
+        """
+        actions: one (n,action_dim) action chunk per environment of env_ids
+        returns list of (obs, rewards, done, completed_tasks, images,
+            records) per environment, obs and images stacked over the n
+            steps, records the recording frames of the steps
+        """
+        if env_ids is None:
+            env_ids = range(len(actions))
+        return self._call("step", actions, env_ids)
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
@@ -1,10 +1,14 @@
 import numpy as np
 import pytorch_lightning as pl
+import math
+
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 import wandb
 from torch import nn
+from xskill.utility.transform import make_windows
 
 
 class Model(pl.LightningModule):
@@ -34,6 +38,8 @@ class Model(pl.LightningModule):
         positive_window=1,
         negative_window=10,
         pretrain_pipeline=None,
+        batch_pretrain_pipeline=None,
+        channels_last=False,
     ):
 
         super(Model, self).__init__()
@@ -70,6 +76,13 @@ class Model(pl.LightningModule):
 
 
         self.pretrain_pipeline = pretrain_pipeline
+        # augments all sliding windows of the batch in one call, see
+        # xskill.utility.transform.get_batch_transform_pipeline
+        self.batch_pretrain_pipeline = batch_pretrain_pipeline
+
+        if channels_last:
+            # convolutions follow the memory format of their weights
+            self.to(memory_format=torch.channels_last)
 
     # @profile
     def forward(self, im_q, bbox_q, im_k=None, bbox_k=None):
@@ -88,12 +101,12 @@ class Model(pl.LightningModule):
 
     # @profile
     def C(self, im_q, bbox_q, zc_q):
-        target = torch.softmax(zc_q.detach() / self.T, dim=1)
+        target = torch.softmax(zc_q.detach().float() / self.T, dim=1)
         # all in one: (bxTxOx4)-> (bxTxf) -> proto logits
         # spatial attention -> temporal attention
         z_logits = self.skill_prior(im_q[:, :self.stack_frames], None)
         criterion = nn.CrossEntropyLoss()
-        loss = criterion(z_logits, target)
+        loss = criterion(z_logits.float(), target)
 
         return loss
 
@@ -113,7 +126,9 @@ class Model(pl.LightningModule):
                 e_optimizer,
                 max_lr=1e-3,
                 epochs=self.trainer.max_epochs,
-                steps_per_epoch=self.steps_per_epoch)
+                # the distributed sampler splits each epoch across ranks
+                steps_per_epoch=math.ceil(self.steps_per_epoch /
+                                          self.trainer.world_size))
             lambda1 = lambda epoch: 1
             s_scheduler = torch.optim.lr_scheduler.LambdaLR(
                 s_optimizer, lr_lambda=[lambda1])
@@ -139,37 +154,49 @@ class Model(pl.LightningModule):
             max_T, min_T + (max_T - min_T) /
             (self.trainer.max_epochs / 2) * self.trainer.current_epoch)
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        """
+        Datasets created with uint8_output=True send raw (B,T,h,w,c) uint8
+        frames. Permute and scale them to (B,T,c,h,w) float on device.
+        """
+        return tuple(self.images_to_float(b) for b in batch)
+
+    @staticmethod
+    def images_to_float(index_batch):
+        eps_im = index_batch[0]
+        if eps_im.dtype != torch.uint8:
+            return index_batch
+        eps_im = eps_im.permute(0, 1, 4, 2, 3).float().div_(255)
+        return index_batch._replace(im_q=eps_im)
+
+    def full_precision(self):
+        """ Disable autocast for the loss math of mixed precision runs. """
+        return torch.autocast(device_type=self.device.type, enabled=False)
+
     def training_step(self, batch, batch_idx):
         robot_batch, human_batch = batch
         self.training_step_helper(robot_batch, batch_idx)
         self.training_step_helper(human_batch, batch_idx)
 
-    # @profile
-    def training_step_helper(self, batch, batch_idx):
-        e_opt, s_opt = self.optimizers()
-        eps_im, _, _ = batch  #(B,T,3,h,w)
-        batch_size = eps_im.shape[0]
-
-        # normalize the prototypes
-        with torch.no_grad():
-            w = self.encoder_q.prototypes.weight.data.clone()
-            w = nn.functional.normalize(w, dim=1, p=2)
-            self.encoder_q.prototypes.weight.copy_(w)
-
-            # normalize the skill prior prototypes layer
-            if self.skill_prior.normalize:
-                v = self.skill_prior.prototypes.weight.data.clone()
-                v = nn.functional.normalize(v, dim=1, p=2)
-                self.skill_prior.prototypes.weight.copy_(v)
-
-        if self.use_temperature_scheduler:
-            self.T = self.temperature_scheduler()
+    def augment_windows(self, eps_im):
+        """
+        eps_im: (B,T,c,h,w)
+        returns two independently augmented views of every sliding window,
+            each (B*(T-slide),slide+1,c,h',w'), or twice that with reverse_augment
+        """
+        windows = make_windows(eps_im, self.slide + 1)  # (B,T-slide,slide+1,c,h,w)
+        im_q = self.batch_pretrain_pipeline(windows)
+        im_k = self.batch_pretrain_pipeline(windows)
+        if self.reverse_augment:
+            # per episode: forward windows followed by reversed windows
+            im_q = torch.cat([im_q, im_q.flip(dims=[2])], dim=1)
+            im_k = torch.cat([im_k, im_k.flip(dims=[2])], dim=1)
+        return im_q.flatten(0, 1), im_k.flatten(0, 1)
 
-        rep_loss = 0
-        cluster_loss = 0
+    def augment_windows_loop(self, eps_im):
         swav_batch_im_q, swav_batch_im_k = [], []
 
-        for i in range(batch_size):
+        for i in range(len(eps_im)):
             im = eps_im[i]
             im_q = torch.stack([
                 self.pretrain_pipeline(im[j:j + self.slide + 1])
@@ -197,11 +224,44 @@ class Model(pl.LightningModule):
 
         swav_batch_im_q = torch.cat(swav_batch_im_q, dim=0)
         swav_batch_im_k = torch.cat(swav_batch_im_k, dim=0)
+        return swav_batch_im_q, swav_batch_im_k
+
+    # @profile
+    def training_step_helper(self, batch, batch_idx):
+        e_opt, s_opt = self.optimizers()
+        eps_im, _, _ = batch  #(B,T,3,h,w)
+        batch_size = eps_im.shape[0]
+
+        # normalize the prototypes
+        with torch.no_grad():
+            w = self.encoder_q.prototypes.weight.data.clone()
+            w = nn.functional.normalize(w, dim=1, p=2)
+            self.encoder_q.prototypes.weight.copy_(w)
+
+            # normalize the skill prior prototypes layer
+            if self.skill_prior.normalize:
+                v = self.skill_prior.prototypes.weight.data.clone()
+                v = nn.functional.normalize(v, dim=1, p=2)
+                self.skill_prior.prototypes.weight.copy_(v)
+
+        if self.use_temperature_scheduler:
+            self.T = self.temperature_scheduler()
+
+        rep_loss = 0
+        cluster_loss = 0
+        if self.batch_pretrain_pipeline is not None:
+            swav_batch_im_q, swav_batch_im_k = self.augment_windows(eps_im)
+        else:
+            swav_batch_im_q, swav_batch_im_k = self.augment_windows_loop(
+                eps_im)
 
         zc_q, zc_k = self.forward(im_q=swav_batch_im_q,
                                   bbox_q=None,
                                   im_k=swav_batch_im_k,
                                   bbox_k=None)
+        # prototype scores of mixed precision runs are upcast, the
+        # sinkhorn and the temperature scaled softmax overflow in fp16
+        zc_q, zc_k = zc_q.float(), zc_k.float()
 
         if self.reverse_augment:
             chunk_zc_q, chunk_zc_k = torch.chunk(zc_q,
@@ -216,72 +276,25 @@ class Model(pl.LightningModule):
             # forward_zc_q, forward_zc_k, reverse_zc_q, reverse_zc_k = chunk_zc_q, chunk_zc_k, None, None
             forward_zc_q, forward_zc_k, reverse_zc_q, reverse_zc_k = chunk_zc_q, chunk_zc_k, chunk_zc_q, chunk_zc_k
 
-        #swav loss
-        with torch.no_grad():
-            assignent_q = self.distributed_sinkhorn(zc_k)
-            assignent_k = self.distributed_sinkhorn(zc_q)
-
-        rep_loss += 0.5 * (-torch.mean(
-            torch.sum(assignent_q * F.log_softmax(zc_q / self.T, dim=1), dim=1)
-        ) - torch.mean(
-            torch.sum(assignent_k * F.log_softmax(zc_k / self.T, dim=1),
-                      dim=1)))
-
-        # cluster loss
-        if self.cluster_loss_coef != 0:
-            for fz, rz in zip(forward_zc_q, reverse_zc_q):
-                totol_segments = len(fz)
-                eps_cluster_loss = 0
-                for idx in range(totol_segments):
-                    positive_proto_idx = np.random.choice(
-                        list(np.arange(idx - self.positive_window, idx)) +
-                        list(np.arange(idx + 1,
-                                       idx + self.positive_window + 1)), 1)
-                    positive_proto_idx = np.clip(positive_proto_idx,
-                                                 a_min=0,
-                                                 a_max=totol_segments - 1)[0]
-                    concat_proto_idxs = [[idx, positive_proto_idx]]
-
-                    if self.time_augment:
-                        negative_proto_idx = np.random.choice(
-                            list(np.arange(idx - self.negative_window)) + list(
-                                np.arange(idx + self.negative_window,
-                                          totol_segments)),
-                            self.n_negative_samples)
-                        negative_proto_idx = np.clip(negative_proto_idx,
-                                                     a_min=0,
-                                                     a_max=totol_segments - 1)
-                        concat_proto_idxs.append(negative_proto_idx.tolist())
-
-                    concat_proto_idxs = np.concatenate(concat_proto_idxs)
-
-                    contcat_z = fz[concat_proto_idxs]
-
-                    if self.reverse_augment:
-                        revserse_proto_idx = np.random.choice(
-                            list(np.arange(idx - self.positive_window, idx)) +
-                            list(
-                                np.arange(idx + 1,
-                                          idx + self.positive_window + 1)),
-                            self.n_negative_samples)
-                        revserse_proto_idx = np.clip(revserse_proto_idx,
-                                                     a_min=0,
-                                                     a_max=totol_segments - 1)
-                        contcat_z = torch.cat(
-                            [contcat_z, rz[revserse_proto_idx]], dim=0)
-
-                    pz, oz = contcat_z[0].unsqueeze(0), contcat_z[1:]
-
-                    logits = torch.mm(pz, oz.t())
-                    logits = logits / self.clutser_T
-                    label = torch.zeros(1).long().cuda()
-                    eps_cluster_loss += nn.CrossEntropyLoss()(logits, label)
-
-                cluster_loss += eps_cluster_loss / totol_segments
+        with self.full_precision():
+            #swav loss
+            with torch.no_grad():
+                assignent_q = self.distributed_sinkhorn(zc_k)
+                assignent_k = self.distributed_sinkhorn(zc_q)
+
+            rep_loss += 0.5 * (-torch.mean(
+                torch.sum(assignent_q * F.log_softmax(zc_q / self.T, dim=1), dim=1)
+            ) - torch.mean(
+                torch.sum(assignent_k * F.log_softmax(zc_k / self.T, dim=1),
+                          dim=1)))
+
+            # cluster loss
+            if self.cluster_loss_coef != 0:
+                cluster_loss = self.temporal_cluster_loss(
+                    torch.stack(forward_zc_q), torch.stack(reverse_zc_q))
 
         ### optimize the encoder
         # rep_loss = rep_loss / batch_size
-        cluster_loss = cluster_loss / batch_size
 
         encoder_loss = self.swav_loss_coef * rep_loss + self.cluster_loss_coef * cluster_loss
         e_opt.zero_grad()
@@ -331,21 +344,105 @@ class Model(pl.LightningModule):
                 self.T
             })
 
+    def sample_neighbour_idxs(self, idx, n, window):
+        """
+        idx: (B,S) segment indices
+        returns (B,S,n) indices drawn uniformly from the `window` segments on
+            either side of idx (idx itself excluded), clipped to the episode
+        """
+        num_segments = idx.shape[1]
+        k = torch.randint(0, 2 * window, (*idx.shape, n), device=idx.device)
+        offset = k - window + (k >= window).long()
+        return (idx.unsqueeze(-1) + offset).clamp(0, num_segments - 1)
+
+    def sample_negative_idxs(self, idx, n):
+        """
+        idx: (B,S) segment indices
+        returns (B,S,n) indices drawn uniformly from the segments at least
+            negative_window away from idx
+        """
+        num_segments = idx.shape[1]
+        # the middle segments have no negative if the segments do not reach
+        # negative_window past both ends of them
+        if self.negative_window > 0 and num_segments <= 2 * self.negative_window:
+            raise ValueError(
+                f"No negative segments at least negative_window="
+                f"{self.negative_window} away among {num_segments} segments, "
+                f"time_augment needs more than {2 * self.negative_window}")
+        n_before = (idx - self.negative_window).clamp(min=0)
+        n_after = (num_segments - idx - self.negative_window).clamp(min=0)
+        n_total = (n_before + n_after).unsqueeze(-1)
+        u = (torch.rand(*idx.shape, n, device=idx.device) * n_total).long()
+        n_before = n_before.unsqueeze(-1)
+        neg_idx = torch.where(
+            u < n_before, u,
+            u - n_before + idx.unsqueeze(-1) + self.negative_window)
+        return neg_idx
+
+    def temporal_cluster_loss(self, forward_z, reverse_z):
+        """
+        forward_z: (B,S,K) prototype logits of the forward windows
+        reverse_z: (B,S,K) prototype logits of the reversed windows
+        For every segment the anchor has to pick its temporal neighbour among
+        the distant segments (time_augment) and the reversed neighbours
+        (reverse_augment). Returns the mean InfoNCE loss over all segments.
+        """
+        batch_size, num_segments, K = forward_z.shape
+        idx = torch.arange(num_segments, device=forward_z.device).expand(
+            batch_size, num_segments)
+
+        other_idxs = [self.sample_neighbour_idxs(idx, 1, self.positive_window)]
+        if self.time_augment:
+            other_idxs.append(
+                self.sample_negative_idxs(idx, self.n_negative_samples))
+        other_idxs = torch.cat(other_idxs, dim=-1)  # (B,S,m)
+
+        def gather(z, z_idx):
+            flat_idx = z_idx.flatten(1).unsqueeze(-1).expand(-1, -1, K)
+            return z.gather(1, flat_idx).view(*z_idx.shape, K)
+
+        other_z = gather(forward_z, other_idxs)  # (B,S,m,K)
+        if self.reverse_augment:
+            reverse_idxs = self.sample_neighbour_idxs(idx,
+                                                      self.n_negative_samples,
+                                                      self.positive_window)
+            other_z = torch.cat([other_z, gather(reverse_z, reverse_idxs)],
+                                dim=2)
+
+        logits = torch.bmm(other_z.flatten(0, 1),
+                           forward_z.flatten(0, 1).unsqueeze(-1)).squeeze(-1)
+        logits = logits / self.clutser_T
+        label = torch.zeros(len(logits), dtype=torch.long, device=logits.device)
+        return F.cross_entropy(logits, label)
+
     # @profile
     @torch.no_grad()
     def distributed_sinkhorn(self, out):
+        """
+        Sinkhorn-Knopp over the samples of all ranks. Every rank keeps only
+        the columns of its local samples, the row and total sums are
+        all-reduced so the prototypes are equally partitioned over the
+        global batch.
+        """
+        distributed = dist.is_available() and dist.is_initialized()
+        world_size = dist.get_world_size() if distributed else 1
+
         Q = torch.exp(out / self.epsilon).t(
         )  # Q is K-by-B for consistency with notations from our paper
-        B = Q.shape[1]  # number of samples to assign
+        B = Q.shape[1] * world_size  # number of samples to assign
         K = Q.shape[0]  # how many prototypes
 
         # make the matrix sums to 1
         sum_Q = torch.sum(Q)
+        if distributed:
+            dist.all_reduce(sum_Q)
         Q /= sum_Q
 
         for it in range(self.sinkhorn_iterations):
             # normalize each row: total weight per prototype must be 1/K
             sum_of_rows = torch.sum(Q, dim=1, keepdim=True)
+            if distributed:
+                dist.all_reduce(sum_of_rows)
             Q /= sum_of_rows
             Q /= K
 
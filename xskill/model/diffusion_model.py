@@ -2,6 +2,7 @@ import math
 from typing import Sequence, Tuple, Union
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision
 from typing import Tuple, Sequence, Dict, Union, Optional, Callable
 
@@ -93,9 +94,31 @@ class ConditionalResidualBlock1D(nn.Module):
         returns:
         out : [ batch_size x out_channels x horizon ]
         """
-        out = self.blocks[0](x)
-        embed = self.cond_encoder(cond)
+        return self.forward_embed(x, self.cond_encoder(cond))
+
+    def encode_cond_slice(self, cond, start, bias=True):
+        """
+        FiLM embedding of the columns start:start+n of the conditioning.
+        The embeddings of disjoint slices, one with bias, sum to the
+        cond_encoder embedding of the whole conditioning.
+        cond : [ batch_size x n ]
+
+        returns:
+        embed : [ batch_size x out_channels*2 ]
+        """
+        linear = self.cond_encoder[1]
+        weight = linear.weight[:, start : start + cond.shape[-1]]
+        return F.linear(F.mish(cond), weight, linear.bias if bias else None)
 
+    def forward_embed(self, x, embed):
+        """
+        x : [ batch_size x in_channels x horizon ]
+        embed : [ batch_size x out_channels*2 (x 1) ] FiLM embedding
+
+        returns:
+        out : [ batch_size x out_channels x horizon ]
+        """
+        out = self.blocks[0](x)
         embed = embed.reshape(embed.shape[0], 2, self.out_channels, 1)
         scale = embed[:, 0, ...]
         bias = embed[:, 1, ...]
@@ -217,6 +240,7 @@ class ConditionalUnet1D(nn.Module):
         )
 
         self.diffusion_step_encoder = diffusion_step_encoder
+        self.diffusion_step_embed_dim = dsed
         self.up_modules = up_modules
         self.down_modules = down_modules
         self.final_conv = final_conv
@@ -239,19 +263,8 @@ class ConditionalUnet1D(nn.Module):
         global_cond: (B,global_cond_dim)
         output: (B,T,input_dim)
         """
-        # (B,T,C)
-        sample = sample.moveaxis(-1, -2)
-        # (B,C,T)
-
         # 1. time
-        timesteps = timestep
-        if not torch.is_tensor(timesteps):
-            # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
-            timesteps = torch.tensor(
-                [timesteps], dtype=torch.long, device=sample.device
-            )
-        elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
-            timesteps = timesteps[None].to(sample.device)
+        timesteps = self.get_timesteps(timestep, sample.device)
         # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
         timesteps = timesteps.expand(sample.shape[0])
 
@@ -260,21 +273,99 @@ class ConditionalUnet1D(nn.Module):
         if global_cond is not None:
             global_feature = torch.cat([global_feature, global_cond], axis=-1)
 
+        embeds = [
+            block.cond_encoder(global_feature)
+            for block in self.conditional_blocks()
+        ]
+        return self.forward_embeds(sample, embeds)
+
+    @staticmethod
+    def get_timesteps(timestep, device):
+        timesteps = timestep
+        if not torch.is_tensor(timesteps):
+            # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
+            timesteps = torch.tensor([timesteps], dtype=torch.long, device=device)
+        elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
+            timesteps = timesteps[None].to(device)
+        return timesteps
+
+    def conditional_blocks(self):
+        """ConditionalResidualBlock1D in the order forward_embeds applies them."""
+        blocks = []
+        for resnet, resnet2, _ in self.down_modules:
+            blocks += [resnet, resnet2]
+        blocks += list(self.mid_modules)
+        for resnet, resnet2, _ in self.up_modules:
+            blocks += [resnet, resnet2]
+        return blocks
+
+    def encode_global_cond(self, global_cond):
+        """
+        Global condition part of the FiLM embedding of every conditional
+        block. It is constant over the denoising steps of a plan, so it is
+        computed once per plan and the steps only add encode_timestep.
+        global_cond: (B,global_cond_dim)
+        output: list of (B,block_channels*2)
+        """
+        start = self.diffusion_step_embed_dim
+        return [
+            block.encode_cond_slice(global_cond, start)
+            for block in self.conditional_blocks()
+        ]
+
+    def encode_timestep(self, timestep):
+        """
+        Diffusion step part of the FiLM embedding of every conditional block.
+        timestep: (n,) or int, e.g. all timesteps of a plan at once
+        output: list of (n,block_channels*2)
+        """
+        device = self.final_conv[1].weight.device
+        timestep_feature = self.diffusion_step_encoder(
+            self.get_timesteps(timestep, device)
+        )
+        return [
+            block.encode_cond_slice(timestep_feature, 0, bias=False)
+            for block in self.conditional_blocks()
+        ]
+
+    def forward_cond(self, sample, global_embeds, timestep_embeds):
+        """
+        forward with the conditioning encoded by encode_global_cond and
+        encode_timestep, same output as forward(sample, timestep, global_cond)
+        sample: (B,T,input_dim)
+        global_embeds: encode_global_cond(global_cond)
+        timestep_embeds: encode_timestep(timestep), batch size 1 or B
+        output: (B,T,input_dim)
+        """
+        embeds = [g + t for g, t in zip(global_embeds, timestep_embeds)]
+        return self.forward_embeds(sample, embeds)
+
+    def forward_embeds(self, sample, embeds):
+        """
+        sample: (B,T,input_dim)
+        embeds: FiLM embedding of every block of conditional_blocks
+        output: (B,T,input_dim)
+        """
+        # (B,T,C)
+        sample = sample.moveaxis(-1, -2)
+        # (B,C,T)
+
+        embeds = iter(embeds)
         x = sample
         h = []
         for idx, (resnet, resnet2, downsample) in enumerate(self.down_modules):
-            x = resnet(x, global_feature)
-            x = resnet2(x, global_feature)
+            x = resnet.forward_embed(x, next(embeds))
+            x = resnet2.forward_embed(x, next(embeds))
             h.append(x)
             x = downsample(x)
 
         for mid_module in self.mid_modules:
-            x = mid_module(x, global_feature)
+            x = mid_module.forward_embed(x, next(embeds))
 
         for idx, (resnet, resnet2, upsample) in enumerate(self.up_modules):
             x = torch.cat((x, h.pop()), dim=1)
-            x = resnet(x, global_feature)
-            x = resnet2(x, global_feature)
+            x = resnet.forward_embed(x, next(embeds))
+            x = resnet2.forward_embed(x, next(embeds))
             x = upsample(x)
 
         x = self.final_conv(x)
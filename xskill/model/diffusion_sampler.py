@@ -0,0 +1,144 @@
+import torch
+from diffusers.schedulers.scheduling_ddim import DDIMScheduler
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+
+SCHEDULERS = {
+    "ddpm": DDPMScheduler,
+    "ddim": DDIMScheduler,
+}
+
+
+def shift_plan(naction, n_steps):
+    """
+    Drop the first n_steps of a (B,T,D) plan and repeat its last step, to
+    line up the previous plan with the next replanning step.
+    """
+    if n_steps <= 0:
+        return naction
+    n_steps = min(n_steps, naction.shape[1] - 1)
+    tail = naction[:, -1:].expand(-1, n_steps, -1)
+    return torch.cat([naction[:, n_steps:], tail], dim=1)
+
+
+class DiffusionSampler:
+    """
+    Reverse diffusion of action plans for rollouts.
+
+    The inference scheduler is built from the config of the training
+    scheduler and its timesteps are set once, instead of on every replanning
+    step. "ddim" denoises in num_inference_steps < num_train_timesteps steps.
+    With warm_start_steps > 0 a plan can start from the previous plan: it is
+    noised to the level of the last warm_start_steps timesteps and only those
+    steps are run.
+
+    Nets with the split conditioning API of ConditionalUnet1D get the FiLM
+    embedding of global_cond once per plan and the embeddings of all
+    timesteps of the plan in one call, every step then only adds the two.
+    """
+
+    def __init__(self,
+                 noise_scheduler,
+                 mode="ddpm",
+                 num_inference_steps=None,
+                 warm_start_steps=0):
+        """
+        noise_scheduler: the diffusers scheduler the net was trained with
+        mode: ddpm or ddim
+        num_inference_steps: denoising steps of a plan started from noise,
+            defaults to the number of training timesteps
+        warm_start_steps: denoising steps of a warm started plan, 0 disables
+            warm starting
+        """
+        if mode not in SCHEDULERS:
+            raise ValueError(f"Unknown sampler mode {mode}, "
+                             f"expected one of {list(SCHEDULERS)}")
+        self.scheduler = SCHEDULERS[mode].from_config(noise_scheduler.config)
+        if num_inference_steps is None:
+            num_inference_steps = noise_scheduler.config.num_train_timesteps
+        self.scheduler.set_timesteps(num_inference_steps)
+        self.timesteps = self.scheduler.timesteps
+        self.warm_start_steps = min(warm_start_steps, len(self.timesteps))
+        self._device_timesteps = dict()
+
+    def device_timesteps(self, device):
+        # one copy per device, the net gets no per step host to device copy
+        if device not in self._device_timesteps:
+            self._device_timesteps[device] = self.timesteps.to(device)
+        return self._device_timesteps[device]
+
+    def step(self, noise_pred, timestep, naction, generators=None):
+        """
+        One reverse diffusion step, with generators every plan of the batch
+        draws its noise from its own generator.
+        """
+        if generators is None:
+            return self.scheduler.step(model_output=noise_pred,
+                                       timestep=timestep,
+                                       sample=naction).prev_sample
+        return torch.cat([
+            self.scheduler.step(model_output=noise_pred[i:i + 1],
+                                timestep=timestep,
+                                sample=naction[i:i + 1],
+                                generator=generator).prev_sample
+            for i, generator in enumerate(generators)
+        ])
+
+    @torch.no_grad()
+    def sample(self,
+               noise_pred_net,
+               global_cond,
+               shape,
+               warm_start=None,
+               generators=None):
+        """
+        noise_pred_net: ConditionalUnet1D
+        global_cond: (B,global_cond_dim)
+        shape: (B,pred_horizon,action_dim)
+        warm_start: optional (B,pred_horizon,action_dim) normalized plan to
+            start from, e.g. shift_plan of the previous plan
+        generators: optional list of B torch.Generator on the device of
+            global_cond, the noise of every plan is drawn from its own
+            generator, so it does not depend on the other plans of the batch.
+            None draws from the global RNG.
+        returns the (B,pred_horizon,action_dim) normalized plan
+        """
+        device = global_cond.device
+        # initialize action from Guassian noise
+        if generators is None:
+            noise = torch.randn(shape, device=device)
+        else:
+            noise = torch.cat([
+                torch.randn((1, ) + tuple(shape[1:]),
+                            device=device,
+                            generator=generator) for generator in generators
+            ])
+        timesteps = self.timesteps
+        device_timesteps = self.device_timesteps(device)
+        if warm_start is not None and self.warm_start_steps > 0:
+            start = len(timesteps) - self.warm_start_steps
+            timesteps = timesteps[start:]
+            device_timesteps = device_timesteps[start:]
+            naction = self.scheduler.add_noise(warm_start, noise,
+                                               timesteps[:1].to(device))
+        else:
+            naction = noise
+
+        split_cond = hasattr(noise_pred_net, "encode_global_cond")
+        if split_cond:
+            global_embeds = noise_pred_net.encode_global_cond(global_cond)
+            # (K,block_channels*2) per block
+            timestep_embeds = noise_pred_net.encode_timestep(device_timesteps)
+
+        for i, (k, device_k) in enumerate(zip(timesteps, device_timesteps)):
+            # predict noise
+            if split_cond:
+                noise_pred = noise_pred_net.forward_cond(
+                    naction, global_embeds,
+                    [t[i:i + 1] for t in timestep_embeds])
+            else:
+                noise_pred = noise_pred_net(sample=naction,
+                                            timestep=device_k,
+                                            global_cond=global_cond)
+            # inverse diffusion step (remove noise)
+            naction = self.step(noise_pred, k, naction, generators)
+        return naction
@@ -177,7 +177,12 @@ class VisualMotionEncoder(nn.Module):
         traj_representation = self.get_traj_representation(
             state_representation)
 
-        # projection
+        return self.project(traj_representation)
+
+    def project(self, traj_representation):
+        """
+        traj_representation: (b,f) -> prototype logits (b,nmb_prototypes)
+        """
         if self.prototypes is not None:
             if self.normalize:
                 traj_representation = nn.functional.normalize(
@@ -185,6 +190,17 @@ class VisualMotionEncoder(nn.Module):
             return self.prototypes(traj_representation)
         return traj_representation
 
+    def window_frame_offsets(self, window_size):
+        """
+        Offsets of the frames of a window that get_state_representation
+        encodes, e.g. [0, window_size - 1] with start_end.
+        """
+        if self.start_end:
+            if self.goal_condition:
+                return [0, window_size - 2, window_size - 1]
+            return [0, window_size - 1]
+        return list(range(window_size))
+
     def get_traj_representation(self, state_representation):
 
         traj_representation = self.temporal_transformer_encoder(
@@ -229,6 +245,12 @@ class VisualMotionPrior(nn.Module):
         """
         state_representation = self.get_state_representation(image,
                                                              state)  #(b,f)
+        return self.project(state_representation)
+
+    def project(self, state_representation):
+        """
+        state_representation: (b,f) -> prototype logits (b,nmb_prototypes)
+        """
         if self.normalize:
             state_representation = nn.functional.normalize(
                 state_representation, dim=1, p=2)
@@ -289,7 +311,12 @@ class AblationVisualMotionEncoder(nn.Module):
         traj_representation = self.get_traj_representation(
             state_representation)
 
-        # projection
+        return self.project(traj_representation)
+
+    def project(self, traj_representation):
+        """
+        traj_representation: (b,f) -> prototype logits (b,nmb_prototypes)
+        """
         if self.prototypes is not None:
             if self.normalize:
                 traj_representation = nn.functional.normalize(
@@ -297,6 +324,17 @@ class AblationVisualMotionEncoder(nn.Module):
             return self.prototypes(traj_representation)
         return traj_representation
 
+    def window_frame_offsets(self, window_size):
+        """
+        Offsets of the frames of a window that get_state_representation
+        encodes, e.g. [0, window_size - 1] with start_end.
+        """
+        if self.start_end:
+            if self.goal_condition:
+                return [0, window_size - 2, window_size - 1]
+            return [0, window_size - 1]
+        return list(range(window_size))
+
     def get_traj_representation(self, state_representation):
 
         traj_representation = self.temporal_transformer_encoder(
@@ -0,0 +1,135 @@
+import numpy as np
+import torch
+
+
+def repeat_last(x, length):
+    """
+    Pad x (n,f) to (length,f) by repeating its last row.
+    """
+    if len(x) >= length:
+        return x
+    return torch.cat([x, x[-1:].expand(length - len(x), -1)])
+
+
+class EmbeddingEngine:
+    """
+    Labels episodes with a trained skill discovery Model.
+
+    Every frame is pushed through the vision encoders once, the sliding
+    windows are built by indexing the cached frame features and the temporal
+    transformer runs on fixed size chunks of windows, so the GPU memory does
+    not grow with the episode length. Several episodes share one batch.
+    Requires an encoder_q with the VisualMotionEncoder interface.
+    """
+
+    def __init__(self,
+                 model,
+                 pipeline,
+                 frame_batch_size=512,
+                 window_batch_size=1024):
+        """
+        model: trained xskill.model.core.Model
+        pipeline: (n,c,h,w) float image transform applied before encoding
+        frame_batch_size: frames per vision encoder call
+        window_batch_size: windows per temporal transformer call
+        """
+        self.model = model
+        self.pipeline = pipeline
+        self.frame_batch_size = frame_batch_size
+        self.window_batch_size = window_batch_size
+        self.device = next(model.parameters()).device
+
+        for name in ("window_frame_offsets", "project",
+                     "get_traj_representation"):
+            if not hasattr(model.encoder_q, name):
+                raise TypeError(
+                    f"EmbeddingEngine needs an encoder_q with the "
+                    f"VisualMotionEncoder interface, "
+                    f"{type(model.encoder_q).__name__} has no {name}()")
+
+        self.window_size = model.slide + 1
+        self.state_offsets = torch.as_tensor(
+            model.encoder_q.window_frame_offsets(self.window_size),
+            device=self.device)
+        self.prior_offsets = torch.arange(model.stack_frames,
+                                          device=self.device)
+
+    @torch.inference_mode()
+    def encode_frames(self, frames):
+        """
+        frames: (n,h,w,c) uint8 array
+        returns per frame features of encoder_q and of the skill prior
+        """
+        encoder_q, skill_prior = self.model.encoder_q, self.model.skill_prior
+        q_features, prior_features = [], []
+        for i in range(0, len(frames), self.frame_batch_size):
+            im = torch.from_numpy(
+                np.ascontiguousarray(frames[i:i + self.frame_batch_size]))
+            im = im.to(self.device, non_blocking=True)
+            im = im.permute(0, 3, 1, 2).float().div_(255)
+            im = self.pipeline(im)
+            q_features.append(encoder_q.vision_encoder(im))
+            prior_features.append(skill_prior.vision_encoder(im))
+        return torch.cat(q_features), torch.cat(prior_features)
+
+    @torch.inference_mode()
+    def label_episodes(self, episodes):
+        """
+        episodes: list of (T,h,w,c) uint8 frame arrays
+        returns for every episode a dict of float32 arrays
+            encode_protos: (T,nmb_prototypes) prototype logits of the window
+                starting at each frame, the last one repeated for the tail
+            softmax_encode_protos: (T,nmb_prototypes)
+            traj_representation: (T,f)
+            affordance_state_embs: (T-slide,nmb_prototypes) skill prior logits
+        """
+        eps_lens = [len(frames) for frames in episodes]
+        for eps_len in eps_lens:
+            if eps_len < self.window_size:
+                raise ValueError(
+                    f"Episode of {eps_len} frames is shorter than a window "
+                    f"of {self.window_size} frames")
+        q_features, prior_features = self.encode_frames(
+            np.concatenate(episodes))
+
+        # first frame of every window, in the concatenated frames
+        eps_begins = np.cumsum([0] + eps_lens[:-1])
+        window_begins = torch.as_tensor(np.concatenate([
+            begin + np.arange(eps_len - self.window_size + 1)
+            for begin, eps_len in zip(eps_begins, eps_lens)
+        ]),
+                                        device=self.device)
+
+        encoder_q, skill_prior = self.model.encoder_q, self.model.skill_prior
+        z, traj_representation, affordance_emb = [], [], []
+        for i in range(0, len(window_begins), self.window_batch_size):
+            begins = window_begins[i:i + self.window_batch_size, None]
+            state_representation = q_features[begins + self.state_offsets]
+            traj = encoder_q.get_traj_representation(state_representation)
+            traj_representation.append(traj)
+            z.append(encoder_q.project(traj))
+            prior_state = prior_features[begins + self.prior_offsets]
+            affordance_emb.append(skill_prior.project(prior_state.flatten(1)))
+        z = torch.cat(z)
+        softmax_z = torch.softmax(z / self.model.T, dim=1)
+        traj_representation = torch.cat(traj_representation)
+        affordance_emb = torch.cat(affordance_emb)
+
+        labels = []
+        num_windows = [eps_len - self.window_size + 1 for eps_len in eps_lens]
+        window_chunks = zip(
+            *[t.split(num_windows)
+              for t in (z, softmax_z, traj_representation, affordance_emb)])
+        for eps_len, (eps_z, eps_softmax_z, eps_traj,
+                      eps_affordance) in zip(eps_lens, window_chunks):
+            labels.append({
+                "encode_protos":
+                repeat_last(eps_z, eps_len).float().cpu().numpy(),
+                "softmax_encode_protos":
+                repeat_last(eps_softmax_z, eps_len).float().cpu().numpy(),
+                "traj_representation":
+                repeat_last(eps_traj, eps_len).float().cpu().numpy(),
+                "affordance_state_embs":
+                eps_affordance.float().cpu().numpy(),
+            })
+        return labels
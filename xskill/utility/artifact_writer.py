@@ -0,0 +1,86 @@
+"""Background writing of evaluation artifacts (videos, plots)."""
+
+import queue
+import threading
+
+import imageio
+
+
+class AsyncArtifactWriter:
+    """
+    Runs artifact writing jobs on one background thread, in submission order.
+    The job queue is bounded, so a producer faster than the writer blocks
+    instead of buffering an unbounded number of frames. An exception of a
+    job is raised again by the next submit, flush or close.
+    """
+
+    def __init__(self, max_queue_size=256):
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    fn, args, kwargs = job
+                    fn(*args, **kwargs)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, fn, *args, **kwargs):
+        self._raise_error()
+        self._queue.put((fn, args, kwargs))
+
+    def video(self, path, **kwargs):
+        """Open a VideoStream to path, kwargs go to imageio.get_writer."""
+        return VideoStream(self, path, **kwargs)
+
+    def flush(self):
+        """Wait until all submitted jobs are written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+
+class VideoStream:
+    """
+    Frames appended to the stream are encoded to the file on the writer
+    thread as they arrive, instead of being held until the episode ends.
+    """
+
+    def __init__(self, writer, path, **kwargs):
+        self.writer = writer
+        self._video = None
+        writer.submit(self._open, path, kwargs)
+
+    def _open(self, path, kwargs):
+        self._video = imageio.get_writer(path, mode="I", **kwargs)
+
+    def _append(self, frame):
+        self._video.append_data(frame)
+
+    def _close(self):
+        self._video.close()
+
+    def append(self, frame):
+        self.writer.submit(self._append, frame)
+
+    def close(self):
+        self.writer.submit(self._close)
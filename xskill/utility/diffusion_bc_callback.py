@@ -1,21 +1,22 @@
 import collections
+import functools
+import hashlib
 import json
 import os
 import os.path as osp
 import hydra
-import imageio
 import numpy as np
 import omegaconf
 import torch
 from PIL import Image
 import random
 from xskill.env.kitchen.v0 import KitchenAllV0
+from xskill.env.kitchen.vector_env import KitchenVectorEnv
+from xskill.model.diffusion_sampler import DiffusionSampler, shift_plan
+from xskill.utility.artifact_writer import AsyncArtifactWriter
 from collections import deque
-import queue
-from xskill.dataset.diffusion_bc_dataset import (
-    normalize_data,
-    unnormalize_data,
-)
+from xskill.dataset.diffusion_bc_dataset import get_data_normalizer
+from xskill.dataset.prototype_store import load_prototypes
 import plotly.graph_objects as go
 from xskill.utility.transform import get_transform_pipeline
 import cv2
@@ -67,6 +68,10 @@ def load_json(path):
     return file
 
 
+# names of the load_demo outputs in the demo cache files
+DEMO_KEYS = ("demo_emd", "demo_proto", "demo_softmax_proto", "demo_skill_rep")
+
+
 def load_pretrain_model(eval_cfg):
     device = torch.device("cuda")
     pretrain_cfg = omegaconf.OmegaConf.load(
@@ -93,7 +98,19 @@ class visual_diffusion_bc_prediction_callback:
         task_progess_ratio=None,
         pretain_model_path=None,
         pretrain_model_ckpt=None,
+        num_envs=1,
+        demo_cache_dir=None,
+        max_artifact_queue=256,
     ) -> None:
+        """
+        num_envs: environments evaluated in parallel by eval_seeds, each in
+            its own worker process. 1 evaluates the seeds one by one in
+            this process.
+        demo_cache_dir: folder to persist the encoded demos in. Encoded demos
+            are always cached in memory.
+        max_artifact_queue: pending jobs (frames, plots) of the background
+            artifact writer before the rollout waits for it
+        """
         self.raw_representation = raw_representation
         self.softmax_prototype = softmax_prototype
         self.prototype = prototype
@@ -101,6 +118,14 @@ class visual_diffusion_bc_prediction_callback:
         self.snap_frames = snap_frames
         self.task_progess_ratio = task_progess_ratio
         self.env = self.create_env()
+        self.num_envs = num_envs
+        self.vector_env = None
+        self._sampler = None
+        self._sampler_key = None
+        self.demo_cache_dir = demo_cache_dir
+        self._demo_cache = dict()
+        self.max_artifact_queue = max_artifact_queue
+        self.artifact_writer = None
 
         if self.task_progess_ratio is not None:
             self.model = self.load_pretrain_model(pretain_model_path,
@@ -127,6 +152,12 @@ class visual_diffusion_bc_prediction_callback:
         random.seed(seed)
         torch.manual_seed(seed)
 
+    def create_generator(self, seed, device):
+        """torch.Generator of the diffusion noise of one rollout."""
+        generator = torch.Generator(device=device)
+        generator.manual_seed(seed)
+        return generator
+
     def sample_snap(self, proto_data):
         eps_len = len(proto_data)
         snap_idx = random.sample(list(range(eps_len)),
@@ -135,82 +166,68 @@ class visual_diffusion_bc_prediction_callback:
         snap = proto_data[snap_idx]  # (snap_frames,D)
         return snap
 
+    def get_demo_cache_key(self, eval_cfg):
+        """Everything the encoded demo depends on."""
+        return (
+            eval_cfg.demo_type,
+            int(eval_cfg.demo_item),
+            str(eval_cfg.pretrain_path),
+            str(eval_cfg.pretrain_ckpt),
+            self.task_progess_ratio,
+            str(eval_cfg.resize_shape),
+            str(eval_cfg.pretrain_pipeline),
+        )
+
     def load_demo(self, eval_cfg):
+        """
+        The encoded demo of eval_cfg, from the in memory cache, the
+        demo_cache_dir or encoded by encode_demo. The arrays are shared
+        between calls, do not modify them.
+        """
+        key = self.get_demo_cache_key(eval_cfg)
+        if key in self._demo_cache:
+            return self._demo_cache[key]
+
+        cache_path = None
+        if self.demo_cache_dir is not None:
+            key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+            cache_path = os.path.join(self.demo_cache_dir,
+                                      f"demo_{key_hash}.npz")
+        if cache_path is not None and os.path.isfile(cache_path):
+            with np.load(cache_path) as f:
+                demo = tuple(f[name] for name in DEMO_KEYS)
+        else:
+            demo = self.encode_demo(eval_cfg)
+            if cache_path is not None:
+                os.makedirs(self.demo_cache_dir, exist_ok=True)
+                tmp_path = cache_path + f".{os.getpid()}.tmp.npz"
+                np.savez(tmp_path, **dict(zip(DEMO_KEYS, demo)))
+                os.replace(tmp_path, cache_path)
+        self._demo_cache[key] = demo
+        return demo
+
+    @torch.no_grad()
+    def encode_demo(self, eval_cfg):
         """
         demo images -> cv2 resize -> torch pipeline
+        returns float32 arrays demo_emd, demo_proto, demo_softmax_proto and
+            demo_skill_rep
         """
         eval_mask = load_json(eval_cfg.eval_mask_path)
         assert eval_cfg.demo_item in np.arange(len(eval_mask))[eval_mask]
         # load demo
         if self.task_progess_ratio is None:
-            if eval_cfg.demo_type == "human":
-                demo_emd = load_json(
-                    os.path.join(
-                        eval_cfg.pretrain_path,
-                        "human_encode_protos",
-                        f"ckpt_{eval_cfg.pretrain_ckpt}",
-                        f"{eval_cfg.demo_item}",
-                        "affordance_state_embs.json",
-                    ))
-                demo_proto = load_json(
-                    os.path.join(
-                        eval_cfg.pretrain_path,
-                        "human_encode_protos",
-                        f"ckpt_{eval_cfg.pretrain_ckpt}",
-                        f"{eval_cfg.demo_item}",
-                        "encode_protos.json",
-                    ))
-                demo_softmax_proto = load_json(
-                    os.path.join(
-                        eval_cfg.pretrain_path,
-                        "human_encode_protos",
-                        f"ckpt_{eval_cfg.pretrain_ckpt}",
-                        f"{eval_cfg.demo_item}",
-                        "softmax_encode_protos.json",
-                    ))
-                demo_skill_rep = load_json(
-                    os.path.join(
-                        eval_cfg.pretrain_path,
-                        "human_encode_protos",
-                        f"ckpt_{eval_cfg.pretrain_ckpt}",
-                        f"{eval_cfg.demo_item}",
-                        "traj_representation.json",
-                    ))
-            else:
-                demo_emd = load_json(
-                    os.path.join(
-                        eval_cfg.pretrain_path,
-                        "encode_protos",
-                        f"ckpt_{eval_cfg.pretrain_ckpt}",
-                        f"{eval_cfg.demo_item}",
-                        "affordance_state_embs.json",
-                    ))
-                demo_proto = load_json(
-                    os.path.join(
-                        eval_cfg.pretrain_path,
-                        "encode_protos",
-                        f"ckpt_{eval_cfg.pretrain_ckpt}",
-                        f"{eval_cfg.demo_item}",
-                        "encode_protos.json",
-                    ))
-                demo_softmax_proto = load_json(
-                    os.path.join(
-                        eval_cfg.pretrain_path,
-                        "encode_protos",
-                        f"ckpt_{eval_cfg.pretrain_ckpt}",
-                        f"{eval_cfg.demo_item}",
-                        "softmax_encode_protos.json",
-                    ))
-                demo_skill_rep = load_json(
-                    os.path.join(
-                        eval_cfg.pretrain_path,
-                        "encode_protos",
-                        f"ckpt_{eval_cfg.pretrain_ckpt}",
-                        f"{eval_cfg.demo_item}",
-                        "traj_representation.json",
-                    ))
-
-            demo_emd = torch.tensor(demo_emd, dtype=torch.float32).cuda()
+            proto_dir = os.path.join(
+                eval_cfg.pretrain_path,
+                "human_encode_protos"
+                if eval_cfg.demo_type == "human" else "encode_protos",
+                f"ckpt_{eval_cfg.pretrain_ckpt}",
+            )
+            demo_emd, demo_proto, demo_softmax_proto, demo_skill_rep = (
+                load_prototypes(proto_dir, eval_cfg.demo_item, [
+                    "affordance_state_embs", "prototypes",
+                    "softmax_prototypes", "raw_rep"
+                ]))
 
         else:
             # sample frames based on ratio
@@ -253,7 +270,9 @@ class visual_diffusion_bc_prediction_callback:
             # demo_emd
             demo_emd = affordance_emb.detach().cpu().numpy()
 
-        return demo_emd, demo_proto, demo_softmax_proto, demo_skill_rep
+        return tuple(
+            np.asarray(x, dtype=np.float32)
+            for x in (demo_emd, demo_proto, demo_softmax_proto, demo_skill_rep))
 
     def load_video(self, eval_cfg):
         # load demo video
@@ -277,192 +296,414 @@ class visual_diffusion_bc_prediction_callback:
         env = KitchenAllV0(use_abs_action=True)
         return env
 
-    def eval(self, nets, noise_scheduler, stats, eval_cfg, save_path, seed):
+    def create_vector_env(self, eval_cfg):
+        record_stride = eval_cfg.get("record_stride", 1)
+        return KitchenVectorEnv(
+            functools.partial(KitchenAllV0, use_abs_action=True),
+            self.num_envs,
+            render_size=eval_cfg.get("render_size", None),
+            resize_shape=tuple(eval_cfg.bc_resize),
+            record_size=eval_cfg.get("record_size", None)
+            if record_stride > 0 else None,
+            record_stride=max(record_stride, 1),
+        )
+
+    def render_obs(self, eval_cfg):
         """
-        pretrain resize doesn't matter here.
-        use bc_resize to resize the env input to desired size
+        Policy frame of size bc_resize. Rendered at that size, unless
+        eval_cfg.render_size is set, then rendered at render_size and resized
+        like the training frames.
         """
-        self.set_seed(seed)
-        device = torch.device("cuda")
-
-        # load demo
+        width, height = eval_cfg.bc_resize
+        render_size = eval_cfg.get("render_size", None)
+        if render_size is None:
+            return self.env.render(width=width, height=height)
+        return cv2.resize(
+            self.env.render(width=render_size, height=render_size),
+            (width, height))
+
+    def render_record(self, image, eval_cfg):
+        """Frame of the eval gif, image or a render of size record_size."""
+        record_size = eval_cfg.get("record_size", None)
+        if record_size is None:
+            return image
+        return self.env.render(width=record_size, height=record_size)
+
+    def close(self):
+        if self.vector_env is not None:
+            self.vector_env.close()
+            self.vector_env = None
+        if self.artifact_writer is not None:
+            self.artifact_writer.close()
+            self.artifact_writer = None
+
+    def get_demo_representation(self, eval_cfg):
         _, demo_proto, demo_softmax_proto, demo_skill_rep = self.load_demo(
             eval_cfg)
         if self.raw_representation:
-            proto_snap = self.sample_snap(demo_skill_rep)  # (snap_frames,D)
+            return demo_skill_rep
         elif self.softmax_prototype:
-            proto_snap = self.sample_snap(
-                demo_softmax_proto)  # (snap_frames,D)
+            return demo_softmax_proto
         elif self.prototype:
-            proto_snap = self.sample_snap(demo_proto)  # (snap_frames,D)
+            return demo_proto
         elif self.one_hot_prototype:
-            pass
+            raise NotImplementedError
+
+    def get_sampler(self, noise_scheduler, eval_cfg):
+        """
+        The DiffusionSampler of eval_cfg, rebuilt only when the scheduler or
+        the sampler settings change.
+        """
+        kwargs = dict(
+            mode=eval_cfg.get("sampler", "ddpm"),
+            num_inference_steps=eval_cfg.get("num_inference_steps",
+                                             eval_cfg.num_diffusion_iters),
+            warm_start_steps=eval_cfg.get("warm_start_steps", 0),
+        )
+        key = (id(noise_scheduler), tuple(kwargs.values()))
+        if self._sampler_key != key:
+            self._sampler = DiffusionSampler(noise_scheduler, **kwargs)
+            self._sampler_key = key
+        return self._sampler
+
+    @torch.no_grad()
+    def predict_action(self, nets, sampler, obs_seq, visual_seq, proto_snap,
+                       eval_cfg, obs_normalizer, action_normalizer,
+                       prev_naction=None, generators=None):
+        """
+        obs_seq: (B,obs_horizon,9) robot joints
+        visual_seq: (B,obs_horizon,h,w,c) uint8 frames of size bc_resize
+        proto_snap: (B,snap_frames,D)
+        prev_naction: (B,pred_horizon,action_dim) normalized previous plan,
+            warm starts the sampler if it is enabled
+        generators: optional list of B torch.Generator of the diffusion noise
+        returns the (B,action_horizon,action_dim) actions to execute, the
+            (B,D) predicted prototypes and the normalized plan
+        """
+        device = proto_snap.device
+        B, obs_horizon = obs_seq.shape[:2]
+        # only convert to tensor.
+        visual_seq = convert_images_to_tensors(
+            visual_seq.reshape((-1, ) + visual_seq.shape[2:]), None).to(device)
+        visual_feature = nets["vision_encoder"](visual_seq).reshape(
+            B, obs_horizon, -1)  # (B,T,visual_feature)
+        # normalize observation
+        nobs = torch.from_numpy(obs_seq).to(device, dtype=torch.float32)
+        nobs = obs_normalizer.normalize(nobs)  # (B,T,obs)
+        # combine visual feature and low dim feature
+        # (B,obs_feature*obs_horizon)
+        obs_feature = torch.cat([visual_feature, nobs], dim=-1).flatten(
+            start_dim=1)
+        nproto = nets["proto_pred_net"](obs_feature, proto_snap)  # (B,D)
+
+        if eval_cfg.upsample_proto:
+            upsample_proto = nets["upsample_proto_net"](
+                nproto)  # (B,upsample_dim)
+            obs_cond = torch.cat([obs_feature, upsample_proto], dim=1)
+        else:
+            obs_cond = torch.cat([obs_feature, nproto], dim=1)
+
+        warm_start = None
+        if prev_naction is not None:
+            # the first action_horizon steps of the previous plan are executed
+            warm_start = shift_plan(prev_naction, eval_cfg.action_horizon)
+        naction = sampler.sample(
+            nets["noise_pred_net"],
+            obs_cond,
+            (B, eval_cfg.pred_horizon, eval_cfg.action_dim),
+            warm_start=warm_start,
+            generators=generators,
+        )
+
+        # unnormalize action
+        # (B, pred_horizon, action_dim)
+        action_pred = action_normalizer.unnormalize(naction)
+        action_pred = action_pred.detach().to("cpu").numpy()
+
+        # only take action_horizon number of actions
+        start = obs_horizon - 1
+        end = start + eval_cfg.action_horizon
+        return action_pred[:, start:end], nproto.detach().cpu().numpy(
+        ), naction
+
+    def get_artifact_writer(self):
+        if self.artifact_writer is None:
+            self.artifact_writer = AsyncArtifactWriter(self.max_artifact_queue)
+        return self.artifact_writer
 
+    def open_recording(self, save_path, seed, eval_cfg):
+        """
+        VideoStream of the eval gif of seed, None if eval_cfg.record_stride
+        is 0. Every record_stride-th frame is recorded.
+        """
+        if eval_cfg.get("record_stride", 1) <= 0:
+            return None
+        eval_save_path = os.path.join(save_path, "evaluation")
+        os.makedirs(eval_save_path, exist_ok=True)
+        video_save_path = osp.join(eval_save_path, f"eval_{seed}.gif")
+        return self.get_artifact_writer().video(video_save_path)
+
+    def record_frames(self, video, frames, first_step, eval_cfg):
+        """frames: images of the steps first_step, first_step+1, ..."""
+        if video is None:
+            return
+        record_stride = eval_cfg.get("record_stride", 1)
+        for step, frame in enumerate(frames, start=first_step):
+            if step % record_stride == 0:
+                video.append(frame)
+
+    def save_rollout(self, save_path, seed, video, predict_protos):
+        if video is not None:
+            video.close()
+        eval_save_path = os.path.join(save_path, "evaluation")
+        os.makedirs(eval_save_path, exist_ok=True)
+        self.get_artifact_writer().submit(
+            save_proto_plot,
+            os.path.join(eval_save_path, f"predict_proto_{seed}.png"),
+            np.array(predict_protos),
+        )
+
+    def eval(self, nets, noise_scheduler, stats, eval_cfg, save_path, seed):
+        """
+        pretrain resize doesn't matter here.
+        the env input is rendered at bc_resize, see render_obs
+        """
+        self.set_seed(seed)
+        device = torch.device("cuda")
+
+        # load demo
+        proto_snap = self.sample_snap(
+            self.get_demo_representation(eval_cfg))  # (snap_frames,D)
         proto_snap = torch.from_numpy(proto_snap).to(device,
                                                      dtype=torch.float32)
         proto_snap = proto_snap.unsqueeze(0)  # (1,snap_frames,D)
 
         # recording
-        imgs = []
+        video = self.open_recording(save_path, seed, eval_cfg)
+        record_stride = eval_cfg.get("record_stride", 1)
 
         # get first observation
         max_steps = eval_cfg.max_steps
         obs = self.env.reset()
         # keep a queue of last 2 steps of observations
         obs_horizon = eval_cfg.obs_horizon
-        img_obs_deque = collections.deque(
-            [
-                cv2.resize(self.env.render(width=384, height=384),
-                           eval_cfg.bc_resize)
-            ] * obs_horizon,
-            maxlen=obs_horizon,
-        )
+        img_obs_deque = collections.deque([self.render_obs(eval_cfg)] *
+                                          obs_horizon,
+                                          maxlen=obs_horizon)
         # only takes in the joint
         obs_deque = collections.deque([obs[:9]] * obs_horizon,
                                       maxlen=obs_horizon)
 
+        # stats.pickle of older runs holds plain min/max dicts
+        obs_normalizer = get_data_normalizer(stats["obs"])
+        action_normalizer = get_data_normalizer(stats["actions"])
+
         done = False
         step_idx = 0
         rewards = list()
-        B = 1
 
         # track completion order
-        task_stack = deque(
-            ["slide cabinet", "light switch", "kettle", "microwave"])
-        complete_queue = queue.Queue()
+        complete_order = []
         predict_protos = []
+        sampler = self.get_sampler(noise_scheduler, eval_cfg)
+        # the noise of the rollout only depends on its seed, as in
+        # eval_vectorized
+        generators = [self.create_generator(seed, device)]
+        naction = None
         while not done:
             # stack the last obs_horizon (2) number of observations
             obs_seq = np.stack(obs_deque)
             visual_seq = np.stack(img_obs_deque)
-            # only convert to tensor.
-            visual_seq = convert_images_to_tensors(visual_seq, None).cuda()
-            # print('visual_seq shape', visual_seq.shape)
-            visual_feature = nets["vision_encoder"](
-                visual_seq)  # (T,visual_feature)
-            # normalize observation
-            nobs = normalize_data(obs_seq, stats=stats["obs"])  # (T,obs)
-            nobs = torch.from_numpy(nobs).to(device, dtype=torch.float32)
-            # combine visual feature and low dim feature
-            obs_feature = torch.cat(
-                [visual_feature, nobs],
-                dim=-1)  # (T,visual_feature+low_dim_feature)
-            # feed in: (1,obs_feature*obs_horizon),(1,snap_frames,D)
-            nproto = nets["proto_pred_net"](
-                obs_feature.unsqueeze(0).flatten(start_dim=1),
-                proto_snap)  # (1,D)
-            predict_protos.append(nproto.squeeze(0).detach().cpu().numpy())
-
-            if eval_cfg.upsample_proto:
-                upsample_proto = nets["upsample_proto_net"](
-                    nproto)  # (1,upsample_dim)
-
-            # infer action
-            with torch.no_grad():
-                if eval_cfg.upsample_proto:
-                    obs_cond = torch.cat(
-                        [
-                            obs_feature.unsqueeze(0).flatten(start_dim=1),
-                            upsample_proto
-                        ],
-                        dim=1,
-                    )
-                else:
-                    obs_cond = torch.cat([
-                        obs_feature.unsqueeze(0).flatten(start_dim=1), nproto
-                    ],
-                                         dim=1)
-
-                # initialize action from Guassian noise
-                noisy_action = torch.randn(
-                    (B, eval_cfg.pred_horizon, eval_cfg.action_dim),
-                    device=device)
-                naction = noisy_action
-
-                # init scheduler
-                noise_scheduler.set_timesteps(eval_cfg.num_diffusion_iters)
-
-                for k in noise_scheduler.timesteps:
-                    # predict noise
-                    noise_pred = nets["noise_pred_net"](sample=naction,
-                                                        timestep=k,
-                                                        global_cond=obs_cond)
-
-                    # inverse diffusion step (remove noise)
-                    naction = noise_scheduler.step(model_output=noise_pred,
-                                                   timestep=k,
-                                                   sample=naction).prev_sample
-
-                # unnormalize action
-                naction = naction.detach().to("cpu").numpy()
-                # (B, pred_horizon, action_dim)
-                naction = naction[0]
-                action_pred = unnormalize_data(naction, stats=stats["actions"])
-
-                # only take action_horizon number of actions
-                start = obs_horizon - 1
-                end = start + eval_cfg.action_horizon
-                action = action_pred[start:end, :]
-
-                # execute action_horizon number of steps
-                # without replanning
-                for i in range(len(action)):
-                    # stepping env
-                    obs, reward, done, info = self.env.step(action[i])
-
-                    # record complete task
-                    for task in info["completed_tasks"]:
-                        if task not in list(complete_queue.queue):
-                            complete_queue.put(task)
-
-                    # save observations
-                    obs_deque.append(obs[:9])
-                    raw_env_image = self.env.render(width=384, height=384)
-                    raw_env_image = np.array(raw_env_image)
-                    raw_env_image = cv2.resize(raw_env_image,
-                                               eval_cfg.bc_resize)
-
-                    # save visual obs
-                    img_obs_deque.append(raw_env_image.copy())
-
-                    # reward/vis
-                    rewards.append(reward)
-                    imgs.append(raw_env_image)
-
-                    # update progress bar
-                    step_idx += 1
-                    if step_idx > max_steps:
-                        done = True
-
-        predict_protos = np.array(predict_protos)
-        eval_save_path = os.path.join(save_path, "evaluation")
-        os.makedirs(eval_save_path, exist_ok=True)
-        # save eval gif
-        video_save_path = osp.join(eval_save_path, f"eval_{seed}.gif")
-        imageio.mimsave(video_save_path, imgs)
-        #
-        fig = go.Figure()
-        D = predict_protos.shape[1]
-        for i in range(D):
-            fig.add_trace(
-                go.Scatter(
-                    x=np.arange(len(predict_protos[:, i])),
-                    y=predict_protos[:, i],
-                    mode="lines",
-                    name=f"proto_{i}",
-                ))
-        fig.update_layout(title="predict proto",
-                          xaxis_title="Iteration",
-                          yaxis_title="Value")
-        fig.write_image(
-            os.path.join(eval_save_path, f"predict_proto_{seed}.png"))
-
-        total_task_completed = set(info["completed_tasks"]).intersection(
-            set(["kettle", "light switch", "microwave", "slide cabinet"]))
-        order_task_completed_reward = 0
-        while not complete_queue.empty() and task_stack:
-            task = complete_queue.get()
-            if task == task_stack[-1]:
-                task_stack.pop()
-                order_task_completed_reward += 1
-        return len(total_task_completed), order_task_completed_reward
+            action, nproto, naction = self.predict_action(
+                nets, sampler, obs_seq[None], visual_seq[None], proto_snap,
+                eval_cfg, obs_normalizer, action_normalizer, naction,
+                generators)
+            action = action[0]
+            predict_protos.append(nproto[0])
+
+            # execute action_horizon number of steps
+            # without replanning
+            for i in range(len(action)):
+                # stepping env
+                obs, reward, done, info = self.env.step(action[i])
+
+                # record complete task
+                for task in info["completed_tasks"]:
+                    if task not in complete_order:
+                        complete_order.append(task)
+
+                # save observations
+                obs_deque.append(obs[:9])
+                raw_env_image = self.render_obs(eval_cfg)
+
+                # save visual obs
+                img_obs_deque.append(raw_env_image)
+
+                # reward/vis
+                rewards.append(reward)
+                if video is not None and step_idx % record_stride == 0:
+                    video.append(self.render_record(raw_env_image, eval_cfg))
+
+                # update progress bar
+                step_idx += 1
+                if step_idx > max_steps:
+                    done = True
+
+        self.save_rollout(save_path, seed, video, predict_protos)
+        return get_task_rewards(info["completed_tasks"], complete_order)
+
+    def eval_vectorized(self, nets, noise_scheduler, stats, eval_cfg,
+                        save_path, seeds):
+        """
+        Roll out one episode per seed at once, one environment per seed in
+        the worker processes of the vector env. The observations of all
+        running environments are denoised in one batch.
+        returns lists of the total and order rewards of the seeds
+        """
+        assert len(seeds) <= self.num_envs
+        if self.vector_env is None:
+            self.vector_env = self.create_vector_env(eval_cfg)
+        device = torch.device("cuda")
+
+        # one snap per seed, sampled as in eval
+        demo_representation = self.get_demo_representation(eval_cfg)
+        proto_snap = []
+        for seed in seeds:
+            self.set_seed(seed)
+            proto_snap.append(self.sample_snap(demo_representation))
+        proto_snap = torch.from_numpy(np.stack(proto_snap)).to(
+            device, dtype=torch.float32)  # (N,snap_frames,D)
+
+        obs_horizon = eval_cfg.obs_horizon
+        obs_deques, img_obs_deques = [], []
+        for obs, image in self.vector_env.reset(seeds):
+            obs_deques.append(
+                collections.deque([obs[:9]] * obs_horizon,
+                                  maxlen=obs_horizon))
+            img_obs_deques.append(
+                collections.deque([image] * obs_horizon, maxlen=obs_horizon))
+
+        # stats.pickle of older runs holds plain min/max dicts
+        obs_normalizer = get_data_normalizer(stats["obs"])
+        action_normalizer = get_data_normalizer(stats["actions"])
+
+        n = len(seeds)
+        done = np.zeros(n, dtype=bool)
+        step_idx = np.zeros(n, dtype=np.int64)
+        videos = [
+            self.open_recording(save_path, seed, eval_cfg) for seed in seeds
+        ]
+        predict_protos = [[] for _ in range(n)]
+        complete_order = [[] for _ in range(n)]
+        completed_tasks = [set() for _ in range(n)]
+        sampler = self.get_sampler(noise_scheduler, eval_cfg)
+        # one noise generator per seed, a rollout gets the same noise as in
+        # eval, whatever num_envs and its position in the batch
+        generators = [self.create_generator(seed, device) for seed in seeds]
+        # latest normalized plan of every env
+        nactions = None
+        while not done.all():
+            env_ids = np.flatnonzero(~done)
+            obs_seq = np.stack([np.stack(obs_deques[i]) for i in env_ids])
+            visual_seq = np.stack(
+                [np.stack(img_obs_deques[i]) for i in env_ids])
+            action, nproto, naction = self.predict_action(
+                nets, sampler, obs_seq, visual_seq, proto_snap[env_ids],
+                eval_cfg, obs_normalizer, action_normalizer,
+                None if nactions is None else nactions[env_ids],
+                [generators[i] for i in env_ids])
+            if nactions is None:
+                nactions = naction
+            else:
+                nactions[env_ids] = naction
+            results = self.vector_env.step(list(action), env_ids=env_ids)
+            for i, eps_nproto, (obs, _, env_done, step_tasks, images,
+                                records) in zip(env_ids, nproto, results):
+                predict_protos[i].append(eps_nproto)
+                obs_deques[i].extend(obs[:, :9])
+                img_obs_deques[i].extend(images)
+                if eval_cfg.get("record_size", None) is None:
+                    self.record_frames(videos[i], images, step_idx[i],
+                                       eval_cfg)
+                elif videos[i] is not None:
+                    # rendered at record_size on the record_stride steps
+                    for frame in records:
+                        videos[i].append(frame)
+                for tasks in step_tasks:
+                    for task in tasks:
+                        if task not in complete_order[i]:
+                            complete_order[i].append(task)
+                completed_tasks[i] = step_tasks[-1]
+                step_idx[i] += len(obs)
+                done[i] = env_done or step_idx[i] > eval_cfg.max_steps
+
+        total_rewards, order_rewards = [], []
+        for i, seed in enumerate(seeds):
+            self.save_rollout(save_path, seed, videos[i], predict_protos[i])
+            total_r, order_r = get_task_rewards(completed_tasks[i],
+                                                complete_order[i])
+            total_rewards.append(total_r)
+            order_rewards.append(order_r)
+        return total_rewards, order_rewards
+
+    def eval_seeds(self, nets, noise_scheduler, stats, eval_cfg, save_path,
+                   seeds):
+        """
+        Evaluate one episode per seed, num_envs episodes at a time.
+        returns lists of the total and order rewards of the seeds
+        """
+        seeds = list(seeds)
+        if self.num_envs <= 1:
+            rewards = [
+                self.eval(nets, noise_scheduler, stats, eval_cfg, save_path,
+                          seed) for seed in seeds
+            ]
+            return [r[0] for r in rewards], [r[1] for r in rewards]
+
+        total_rewards, order_rewards = [], []
+        for i in range(0, len(seeds), self.num_envs):
+            total_r, order_r = self.eval_vectorized(
+                nets, noise_scheduler, stats, eval_cfg, save_path,
+                seeds[i:i + self.num_envs])
+            total_rewards.extend(total_r)
+            order_rewards.extend(order_r)
+        return total_rewards, order_rewards
+
+
+def save_proto_plot(path, predict_protos):
+    """predict_protos: (n_plans,D) predicted prototypes of a rollout"""
+    fig = go.Figure()
+    D = predict_protos.shape[1]
+    for i in range(D):
+        fig.add_trace(
+            go.Scatter(
+                x=np.arange(len(predict_protos[:, i])),
+                y=predict_protos[:, i],
+                mode="lines",
+                name=f"proto_{i}",
+            ))
+    fig.update_layout(title="predict proto",
+                      xaxis_title="Iteration",
+                      yaxis_title="Value")
+    fig.write_image(path)
+
+
+def get_task_rewards(completed_tasks, complete_order):
+    """
+    completed_tasks: tasks completed at the end of the episode
+    complete_order: tasks in the order they were first completed
+    returns the number of completed target tasks and the number of target
+        tasks completed in the target order
+    """
+    total_task_completed = set(completed_tasks).intersection(
+        set(["kettle", "light switch", "microwave", "slide cabinet"]))
+    task_stack = deque(
+        ["slide cabinet", "light switch", "kettle", "microwave"])
+    order_task_completed_reward = 0
+    for task in complete_order:
+        if not task_stack:
+            break
+        if task == task_stack[-1]:
+            task_stack.pop()
+            order_task_completed_reward += 1
+    return len(total_task_completed), order_task_completed_reward
@@ -1,5 +1,6 @@
 from torchvision import datasets, transforms
 import torchvision.transforms as Tr
+import torch
 import torch.nn as nn
 
 TRANSFORMS = {
@@ -53,4 +54,302 @@ def get_transform_pipeline(pipeline):
     pipeline_transform = [TRANSFORMS[k] for k in pipeline]
     pipeline_transform = nn.Sequential(*pipeline_transform)
 
-    return pipeline_transform
\ No newline at end of file
+    return pipeline_transform
+
+# ======= batched augmentation =======
+# The modules below take clips of shape (*batch, T, C, H, W) and sample one set
+# of random parameters per clip, shared by its T frames. This matches calling
+# the torchvision transform above once per clip, but in a single batched call.
+
+
+def _param_shape(x):
+    """Shape to broadcast per clip parameters against (*batch, T, C, H, W)."""
+    return x.shape[:-4] + (1, 1, 1, 1)
+
+
+def _rgb_to_grayscale(x):
+    r, g, b = x.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def _blend(x1, x2, ratio):
+    return (ratio * x1 + (1.0 - ratio) * x2).clamp(0, 1.0)
+
+
+def _rgb2hsv(x):
+    r, g, b = x.unbind(dim=-3)
+    maxc = torch.max(x, dim=-3).values
+    minc = torch.min(x, dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def _hsv2rgb(x):
+    h, s, v = x.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32) % 6
+    p = torch.clamp((v * (1.0 - s)), 0.0, 1.0)
+    q = torch.clamp((v * (1.0 - s * f)), 0.0, 1.0)
+    t = torch.clamp((v * (1.0 - s * (1.0 - f))), 0.0, 1.0)
+    mask = i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(
+        -1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    a4 = torch.stack((a1, a2, a3), dim=-4)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(dtype=x.dtype),
+                        a4)
+
+
+def _uniform(low, high, shape, device):
+    return torch.empty(shape, device=device).uniform_(low, high)
+
+
+def _bernoulli(p, shape, device):
+    return torch.rand(shape, device=device) < p
+
+
+class BatchCenterCrop(nn.Module):
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+    def forward(self, x):
+        h, w = x.shape[-2:]
+        th, tw = self.size
+        top = int(round((h - th) / 2.0))
+        left = int(round((w - tw) / 2.0))
+        return x[..., top:top + th, left:left + tw]
+
+
+class BatchRandomCrop(nn.Module):
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+    def forward(self, x):
+        """
+        Gathers the crops with one advanced index, so x may be a strided view
+        (e.g. overlapping windows from unfold) without being materialized.
+        """
+        lead = x.shape[:-4]
+        h, w = x.shape[-2:]
+        th, tw = self.size
+        device = x.device
+        top = torch.randint(0, h - th + 1, lead, device=device)
+        left = torch.randint(0, w - tw + 1, lead, device=device)
+        rows = top[..., None] + torch.arange(th, device=device)  # (*lead,th)
+        cols = left[..., None] + torch.arange(tw, device=device)  # (*lead,tw)
+        lead_idx = torch.meshgrid(
+            *[torch.arange(n, device=device) for n in lead], indexing="ij")
+        index = tuple(i[..., None, None] for i in lead_idx) + (
+            slice(None),
+            slice(None),
+            rows[..., :, None],
+            cols[..., None, :],
+        )
+        out = x[index]  # (*lead,th,tw,T,C)
+        n = len(lead)
+        return out.permute(*range(n), n + 2, n + 3, n, n + 1)
+
+
+class BatchRandomFlip(nn.Module):
+
+    def __init__(self, dim, p=0.5):
+        super().__init__()
+        self.dim = dim
+        self.p = p
+
+    def forward(self, x):
+        mask = _bernoulli(self.p, _param_shape(x), x.device)
+        return torch.where(mask, x.flip(self.dim), x)
+
+
+class BatchRandomGrayscale(nn.Module):
+
+    def __init__(self, p=0.1):
+        super().__init__()
+        self.p = p
+
+    def forward(self, x):
+        mask = _bernoulli(self.p, _param_shape(x), x.device)
+        return torch.where(mask, _rgb_to_grayscale(x).expand_as(x), x)
+
+
+class BatchColorJitter(nn.Module):
+    """
+    Per clip jitter factors. Unlike torchvision the order of the four
+    adjustments is drawn once per call instead of once per clip.
+    """
+
+    def __init__(self, brightness=0, contrast=0, saturation=0, hue=0, p=1.0):
+        super().__init__()
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.p = p
+
+    def forward(self, x):
+        shape = _param_shape(x)
+        device = x.device
+        out = x
+        for fn_id in torch.randperm(4).tolist():
+            if fn_id == 0 and self.brightness > 0:
+                f = _uniform(1 - self.brightness, 1 + self.brightness, shape,
+                             device)
+                out = _blend(out, torch.zeros_like(out), f)
+            elif fn_id == 1 and self.contrast > 0:
+                f = _uniform(1 - self.contrast, 1 + self.contrast, shape,
+                             device)
+                mean = _rgb_to_grayscale(out).mean(dim=(-3, -2, -1),
+                                                   keepdim=True)
+                out = _blend(out, mean, f)
+            elif fn_id == 2 and self.saturation > 0:
+                f = _uniform(1 - self.saturation, 1 + self.saturation, shape,
+                             device)
+                out = _blend(out, _rgb_to_grayscale(out), f)
+            elif fn_id == 3 and self.hue > 0:
+                f = _uniform(-self.hue, self.hue, shape, device)
+                h, s, v = _rgb2hsv(out).unbind(dim=-3)
+                h = (h + f.squeeze(-3)) % 1.0
+                out = _hsv2rgb(torch.stack((h, s, v), dim=-3))
+        mask = _bernoulli(self.p, shape, device)
+        return torch.where(mask, out, x)
+
+
+class BatchGaussianBlur(nn.Module):
+
+    def __init__(self, kernel_size, sigma, p=1.0):
+        super().__init__()
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+        self.p = p
+
+    def forward(self, x):
+        lead = x.shape[:-4]
+        mask = _bernoulli(self.p, lead, x.device)
+        if not mask.any():
+            return x
+        selected = x[mask]  # (M,T,C,H,W)
+        m, t, c, h, w = selected.shape
+        sigma = _uniform(self.sigma[0], self.sigma[1], (m, 1), x.device)
+        half = (self.kernel_size - 1) * 0.5
+        grid = torch.linspace(-half,
+                              half,
+                              steps=self.kernel_size,
+                              device=x.device)
+        kernel = torch.exp(-0.5 * (grid[None] / sigma).pow(2))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)  # (M,k)
+        kernel = kernel.repeat_interleave(t * c, dim=0).to(x.dtype)
+
+        # separable depthwise convolution, one group per (clip,frame,channel)
+        pad = self.kernel_size // 2
+        blurred = selected.reshape(1, m * t * c, h, w)
+        blurred = nn.functional.pad(blurred, [pad, pad, pad, pad],
+                                    mode="reflect")
+        blurred = nn.functional.conv2d(blurred,
+                                       kernel[:, None, :, None],
+                                       groups=m * t * c)
+        blurred = nn.functional.conv2d(blurred,
+                                       kernel[:, None, None, :],
+                                       groups=m * t * c)
+        out = x.clone()
+        out[mask] = blurred.reshape(m, t, c, h, w)
+        return out
+
+
+class BatchNormalize(nn.Module):
+
+    def __init__(self, mean, std):
+        super().__init__()
+        # not persistent, the pipeline must not change the model state dict
+        self.register_buffer("mean",
+                             torch.tensor(mean).view(-1, 1, 1),
+                             persistent=False)
+        self.register_buffer("std",
+                             torch.tensor(std).view(-1, 1, 1),
+                             persistent=False)
+
+    def forward(self, x):
+        return (x - self.mean.to(x.device)) / self.std.to(x.device)
+
+
+class PerClipTransform(nn.Module):
+    """Fallback for transforms without a batched implementation."""
+
+    def __init__(self, transform):
+        super().__init__()
+        self.transform = transform
+
+    def forward(self, x):
+        lead = x.shape[:-4]
+        clips = x.reshape(-1, *x.shape[-4:])
+        out = torch.stack([self.transform(clip) for clip in clips])
+        return out.reshape(*lead, *out.shape[1:])
+
+
+BATCH_TRANSFORMS = {
+    "center_crop_110_146":
+    BatchCenterCrop((110, 146)),
+    "center_crop_112_112":
+    BatchCenterCrop((112, 112)),
+    "random_crop_216_288":
+    BatchRandomCrop((216, 288)),
+    "random_crop_110_146":
+    BatchRandomCrop((110, 146)),
+    "random_crop_112_112":
+    BatchRandomCrop((112, 112)),
+    "grayscale":
+    BatchRandomGrayscale(p=0.2),
+    "horizontal_flip":
+    BatchRandomFlip(dim=-1),
+    "vertical_flip":
+    BatchRandomFlip(dim=-2),
+    "gaussian_blur":
+    BatchGaussianBlur(kernel_size=11, sigma=[1, 2], p=0.2),
+    "color_jitter":
+    BatchColorJitter(brightness=0.4,
+                     contrast=0.4,
+                     hue=0.1,
+                     saturation=0.1,
+                     p=0.8),
+    "normalize":
+    BatchNormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+}
+
+
+def get_batch_transform_pipeline(pipeline):
+    """
+    Batched counterpart of get_transform_pipeline for clips of shape
+    (*batch, T, C, H, W). Keys without a batched implementation fall back to
+    applying the torchvision transform clip by clip.
+    """
+    pipeline_transform = [
+        BATCH_TRANSFORMS[k]
+        if k in BATCH_TRANSFORMS else PerClipTransform(TRANSFORMS[k])
+        for k in pipeline
+    ]
+    return nn.Sequential(*pipeline_transform)
+
+
+def make_windows(x, window_size):
+    """
+    Sliding windows over the time dim of x (B,T,C,H,W) as a strided view of
+    shape (B,T-window_size+1,window_size,C,H,W), without copying.
+    """
+    return x.unfold(1, window_size, 1).permute(0, 1, 5, 2, 3, 4)